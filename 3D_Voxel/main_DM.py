@@ -15,6 +15,7 @@ from hyper_params import load_default
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 from DDiF import DDiF
+from SynSet.arguments import add_synset_args
 from tqdm import tqdm
 
 def main():
@@ -54,6 +55,7 @@ def main():
     parser.add_argument('--lr_nf', type=float)
     parser.add_argument('--epochs_init', type=int, default=5000)
     parser.add_argument('--lr_nf_init', type=float, default=5e-4)
+    add_synset_args(parser, res_schedule=False)
 
     args = parser.parse_args()
     set_seed(args.seed)
@@ -61,8 +61,10 @@ def main():
     parser.add_argument('--lr_nf', type=float)
     parser.add_argument('--epochs_init', type=int, default=5000)
     parser.add_argument('--lr_nf_init', type=float, default=5e-4)
+    add_synset_args(parser, distributed=True)
 
     args = parser.parse_args()
+    init_distributed(args)
     set_seed(args.seed)
     args = load_default(args)
 
@@ -77,12 +79,14 @@ def main():
         sub_save_path_2 += f"_ZCA"
 
     args.save_path = f"{args.save_path}/{sub_save_path_1}/{sub_save_path_2}#{args.FLAG}"
-    if not os.path.exists(args.save_path):
-        os.makedirs(args.save_path)
-        os.makedirs(f"{args.save_path}/imgs")
+    if is_main(args):
+        if not os.path.exists(args.save_path):
+            os.makedirs(args.save_path)
+            os.makedirs(f"{args.save_path}/imgs")
 
-    shutil.copy(f"./scripts/{args.sh_file}", f"{args.save_path}/{args.sh_file}")
-    args.log_path = f"{args.save_path}/log.txt"
+        shutil.copy(f"./scripts/{args.sh_file}", f"{args.save_path}/{args.sh_file}")
+    barrier()
+    args.log_path = f"{args.save_path}/log.txt" if is_main(args) else os.devnull
 
     eval_it_pool = np.arange(0, args.Iteration+1, 500).tolist() if args.eval_mode == 'S' or args.eval_mode == 'SS' else [args.Iteration] # The list of iterations when we evaluate models and record results.
     channel, im_size, num_classes, class_names, mean, std, dst_train, dst_test, testloader, loader_train_dict, class_map, class_map_inv = get_dataset(args.dataset, args.data_path, args.batch_real, args.subset, args=args)
@@ -118,6 +122,7 @@ def main():
         best_acc = {m: 0 for m in model_eval_pool}
         best_std = {m: 0 for m in model_eval_pool}
 
+        res_schedule = ResSchedule(args.res_schedule, im_size)
         save_and_print(args.log_path, '%s training begins'%get_time())
 
         for it in range(args.Iteration+1):
@@ -154,7 +159,8 @@ def main():
                         best_acc[model_eval] = acc_test_mean
                         best_std[model_eval] = acc_test_std
                         save_this_it = True
-                        torch.save({"best_acc": best_acc, "best_std": best_std}, f"{args.save_path}/best_performance.pt")
+                        if is_main(args):
+                            torch.save({"best_acc": best_acc, "best_std": best_std}, f"{args.save_path}/best_performance.pt")
                     save_and_print(args.log_path, 'Evaluate %d random %s, mean = %.4f std = %.4f\n-------------------------' % (len(accs_test), model_eval, acc_test_mean, acc_test_std))
                     save_and_print(args.log_path, f"{args.save_path}")
                     save_and_print(args.log_path, f"{it:5d} | Accuracy/{model_eval}: {acc_test_mean}")
@@ -170,14 +176,20 @@ def main():
                     image_syn_vis[:, ch] = image_syn_vis[:, ch] * std[ch] + mean[ch]
                 image_syn_vis[image_syn_vis<0] = 0.0
                 image_syn_vis[image_syn_vis>1] = 1.0
-                save_image(image_syn_vis, save_name, nrow=synset.num_per_class) # Trying normalize = True/False may get better visual effects.
+                if is_main(args):
+                    save_image(image_syn_vis, save_name, nrow=synset.num_per_class) # Trying normalize = True/False may get better visual effects.
                 del image_syn_vis
 
-                if save_this_it:
+                if synset.broadcast(save_this_it): # the synset is gathered from all processes with --distributed
                     synset.save(name=f"DDiF_DC_{args.ipc}ipc#synset_best.pt")
 
             ''' Train synthetic data '''
-            net = get_network(args.model, channel, num_classes, im_size).to(args.device) # get a random model
+            res = res_schedule.resolution(it)
+            if it > 0 and res_schedule.stage(it) != res_schedule.stage(it - 1):
+                save_and_print(args.log_path, f"Resolution {res} from iteration {it}\n{res_schedule.summary()}")
+            res_schedule.start()
+
+            net = get_network(args.model, channel, num_classes, res).to(args.device) # get a random model
             net.train()
             net_parameters = list(net.parameters())
             optimizer_net = torch.optim.SGD(net.parameters(), lr=args.lr_net)  # optimizer_img for synthetic data
@@ -197,7 +209,7 @@ def main():
                     if 'BatchNorm' in module._get_name(): #BatchNorm
                         BN_flag = True
                 if BN_flag:
-                    img_real = torch.cat([get_images(images_all, indices_class, c, BNSizePC) for c in range(num_classes)], dim=0)
+                    img_real = resize(torch.cat([get_images(images_all, indices_class, c, BNSizePC) for c in range(num_classes)], dim=0), res)
                     net.train() # for updating the mu, sigma of BatchNorm
                     output_real = net(img_real) # get running mu, sigma
                     for module in net.modules():
@@ -207,7 +219,7 @@ def main():
                 ''' update synthetic data '''
                 loss = torch.tensor(0.0).to(args.device)
                 for c in range(num_classes):
-                    img_real = get_images(images_all, indices_class, c, args.batch_real)
+                    img_real = resize(get_images(images_all, indices_class, c, args.batch_real), res)
                     lab_real = torch.ones((img_real.shape[0],), device=args.device, dtype=torch.long) * c
 
                     if args.batch_syn > 0:
@@ -215,10 +227,10 @@ def main():
                     else:
                         indices = range(c * synset.num_per_class, (c + 1) * synset.num_per_class)
 
-                    img_syn, lab_syn = synset.get(indices=indices)
+                    img_syn, lab_syn = synset.get(indices=indices, resolution=res)
 
                     if args.dsa:
-                        seed = int(time.time() * 1000) % 100000
+                        seed = broadcast_object(int(time.time() * 1000) % 100000) # the same augmentation on all processes with --distributed
                         img_real = DiffAugment(img_real, args.dsa_strategy, seed=seed, param=args.dsa_param)
                         img_syn = DiffAugment(img_syn, args.dsa_strategy, seed=seed, param=args.dsa_param)
 
@@ -242,17 +254,20 @@ def main():
                     break
 
                 ''' update network '''
-                image_syn_train, label_syn_train = synset.get(need_copy=True)
+                image_syn_train, label_syn_train = synset.get(need_copy=True, resolution=res)
                 dst_syn_train = TensorDataset(image_syn_train, label_syn_train)
                 trainloader = torch.utils.data.DataLoader(dst_syn_train, batch_size=args.batch_train, shuffle=True, num_workers=0)
                 for il in range(args.inner_loop):
                     epoch('train', trainloader, net, optimizer_net, criterion, args, aug = True if args.dsa else False)
 
             loss_avg /= (num_classes*args.outer_loop)
+            res_schedule.stop(it)
 
             if it%10 == 0:
                 save_and_print(args.log_path, '%s iter = %04d, loss = %.4f' % (get_time(), it, loss_avg))
 
+        save_and_print(args.log_path, f"Time per resolution stage\n{res_schedule.summary()}")
+
 
 if __name__ == '__main__':
     main()
@@ -1,18 +1,55 @@
 import numpy as np
 import torch
 import copy
-import time
 
-from utils import get_time, save_and_print
+from utils import save_and_print
+from .field_bank import FIELDS, SparseFieldAdam, to_index_tensor, measure_decode, coordinate_grid
+from .synset_io import pack, unpack, save_packed, load_synset, to_legacy
+from .init_cache import InitCache, tensor_digest
+from .distributed import shard_bounds, build_shard, all_gather_rows, broadcast_object, barrier, sync_rng, GatherDecoded
+
+import contextlib
 
 import os
 from tqdm import tqdm
-from torch import nn
-from math import sqrt
 from torchvision.utils import save_image
 
+# Largest max abs error (in units of the normalized data) of a reduced precision decode against fp32, above which
+# DDiF falls back to the fp32 decode
+DECODE_DTYPE_TOLERANCE = {"bf16": 5e-2, "fp16": 1e-2}
+
+
+class ShapeSpec():
+    # Shape of a synthetic instance, the only part of DDiF that depends on the domain
+    #   grid:        native grid of the neural field, e.g. (H, W) for images, (F, H, W) for videos, (D, H, W) for voxels
+    #   channel_dim: axis of the channels in a batch, 1 for (N, C, *grid) and 2 for videos (N, F, C, H, W)
+    #   coord_norm:  coordinate k spans [-1, 1] over coord_norm[k] grid steps, by default the first axis for all axes
+    #                (as in to_coordinates_and_features)
+    def __init__(self, domain, grid, channel, channel_dim=1, coord_norm=None):
+        self.domain = domain
+        self.grid = tuple(int(s) for s in grid)
+        self.channel = channel
+        self.channel_dim = channel_dim
+        self.coord_norm = tuple(coord_norm) if coord_norm is not None else (self.grid[0] - 1,) * len(self.grid)
+
+    def numel(self):
+        return self.channel * int(np.prod(self.grid))
+
+    def to_values(self, x):
+        # batch in the layout of the domain -> (N, prod(grid), channel) in the order of the coordinates
+        return x.movedim(self.channel_dim, -1).reshape(len(x), -1, self.channel)
+
+    def from_values(self, values, resolution):
+        # (N, prod(resolution), channel) -> batch in the layout of the domain
+        return values.reshape(-1, *resolution, self.channel).movedim(-1, self.channel_dim).contiguous()
+
+
 class DDiF():
-    def __init__(self, args):
+    # False: the number of instances per class is --dipc as given, without the check against the budget of ipc real
+    # instances (the videos of Video/DDiF.py)
+    check_budget = True
+
+    def __init__(self, args, spec=None):
         ### Basic ###
         self.args = args
         self.log_path = self.args.log_path
@@ -21,6 +58,7 @@ class DDiF():
         self.im_size = self.args.im_size
         self.device = self.args.device
         self.ipc = self.args.ipc
+        self.spec = ShapeSpec("image", self.im_size, self.channel) if spec is None else spec
 
         ### DDiF ###
         self.dim_in = self.args.dim_in
@@ -32,240 +70,311 @@ class DDiF():
         self.lr_nf = self.args.lr_nf
         self.epochs_init = self.args.epochs_init
         self.lr_nf_init = self.args.lr_nf_init
-
-        self.dist = torch.cuda.device_count() > 1
-
-        nf_temp = Siren(dim_in=self.dim_in, dim_hidden=self.layer_size, dim_out=self.dim_out, num_layers=self.num_layers, final_activation=torch.nn.Identity(), w0_initial=self.w0_initial, w0=self.w0)
-        self.budget_per_instance = sum(sum(t.nelement() for t in tensors) for tensors in (nf_temp.parameters(), nf_temp.buffers()))
-
-        if self.args.dipc > 0:
+        self.init_chunk = self.args.init_chunk
+        self.init_target_mse = self.args.init_target_mse
+        self.decode_mem = self.args.decode_mem
+        self.checkpoint_decode = self.args.checkpoint_decode
+        self.decode_dtype = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}[self.args.decode_dtype]
+        self.compile_decode = self.args.compile_decode
+        self.save_format = self.args.save_format
+        self.init_cache_dir = self.args.init_cache_dir
+        self.init_cache_max_gb = self.args.init_cache_max_gb
+        self.init_cache_max_age = self.args.init_cache_max_age
+        self.nf_optim = self.args.nf_optim
+        self.field = self.args.field
+        self.rank = vars(self.args).get("rank", 0)
+        self.world_size = vars(self.args).get("world_size", 1)
+
+        nf_temp = self.build_field(num_instances=1)
+        self.budget_per_instance = nf_temp.budget_per_instance()
+
+        if self.args.dipc > 0 or not self.check_budget:
             self.num_per_class = self.args.dipc
         else:
-            self.num_per_class = int(self.ipc * self.channel * self.im_size[0] * self.im_size[1] / self.budget_per_instance)
+            self.num_per_class = int(self.ipc * self.spec.numel() / self.budget_per_instance)
 
-        if (self.num_per_class * self.budget_per_instance > self.ipc * self.channel * self.im_size[0] * self.im_size[1]) or (self.num_per_class < 1):
-            save_and_print(self.log_path, f"Invalid Budget")
-            os.rename(self.args.save_path, self.args.save_path+"#InvalidBudget")
+        if self.check_budget and ((self.num_per_class * self.budget_per_instance > self.ipc * self.spec.numel()) or (self.num_per_class < 1)):
+            save_and_print(self.log_path, "Invalid Budget")
+            if self.rank == 0:
+                os.rename(self.args.save_path, self.args.save_path+"#InvalidBudget")
             exit()
 
         del nf_temp
 
-    def init(self, images_real, labels_real, indices_class):
-        save_and_print(self.log_path, "="*50 + "\n SynSet Initialization")
+        # Instances [shard[0], shard[1]) are owned by this process (all instances without --distributed, see distributed.py)
+        num_instances = self.num_classes * self.num_per_class
+        assert num_instances >= self.world_size, f"{num_instances} instances cannot be sharded over {self.world_size} processes"
+        self.shard = shard_bounds(num_instances, self.rank, self.world_size)
+        self.shard_counts = [stop - start for start, stop in (shard_bounds(num_instances, r, self.world_size) for r in range(self.world_size))]
 
-        criterion = torch.nn.MSELoss().to(self.device)
+    def init(self, data_real, labels_real, indices_class):
+        save_and_print(self.log_path, "="*50 + "\n SynSet Initialization")
 
         ### Initialize Coordinate ###
-        image_temp = torch.rand((self.channel, self.im_size[0], self.im_size[1]), device=self.device)
-        self.coord, _ = to_coordinates_and_features(image_temp)
-        self.coord = self.coord.to(self.device)
-        del image_temp
+        self.coord = coordinate_grid(self.spec.grid, self.spec.grid, self.spec.coord_norm, self.device)
 
         ### Initialize Synthetic Neural Field ###
-        self.nf_syn = torch.nn.ModuleList([Siren(dim_in=self.dim_in, dim_hidden=self.layer_size, dim_out=self.dim_out, num_layers=self.num_layers, final_activation=torch.nn.Identity(), w0_initial=self.w0_initial, w0=self.w0)
-                                            for _ in range(self.num_classes * self.num_per_class)])
-        if self.dist:
-            self.nf_syn = nn.DataParallel(self.nf_syn)
+        # the rows of this shard out of the initialization of all instances (see build_shard)
+        self.nf_syn = build_shard(self.build_field, self.num_classes * self.num_per_class, self.shard)
         self.nf_syn = self.nf_syn.to(self.device)
+        if self.compile_decode:
+            compiled, reason = self.nf_syn.compile_decode(self.coord)
+            save_and_print(self.log_path, f"Compiled decode: {'enabled' if compiled else f'fallback to eager ({reason})'}")
 
-        # Check if there is initialized neural fields
-        initialized_synset_path = f"../initialized_synset/{self.args.dataset}_{self.args.subset}_{self.args.res}_{self.args.model}_{self.args.ipc}ipc_{self.args.dipc}dipc/" \
-                                  f"init#({self.dim_in},{self.num_layers},{self.layer_size},{self.dim_out})_({self.w0_initial},{self.w0})_({self.epochs_init},{self.lr_nf_init:.0e}).pt"
-
-        if hasattr(self.args, "zca"):
-            if self.args.zca:
-                initialized_synset_path = f"{initialized_synset_path[:-3]}_ZCA.pt"
-
-        if os.path.isfile(initialized_synset_path):
-            save_and_print(self.log_path, f"\n Load from >>>>> {initialized_synset_path} \n")
-
-            data = torch.load(initialized_synset_path)
-            nf_syn_state_dict = data["nf"]
-            assert len(nf_syn_state_dict) == self.num_classes * self.num_per_class
-            for idx in range(len(nf_syn_state_dict)):
-                if self.dist:
-                    self.nf_syn.module[idx].load_state_dict(nf_syn_state_dict[idx])
-                else:
-                    self.nf_syn[idx].load_state_dict(nf_syn_state_dict[idx])
-
-        else:
-            save_and_print(self.log_path, f"\n No initialized synset >>>>> {initialized_synset_path} \n")
-
-            images_init = [images_real[np.random.permutation(indices_class[c])[:self.num_per_class]] for c in range(self.num_classes)]
-            images_init = torch.cat(images_init, dim=0)
-
-            total_recon_loss = []
-            for idx in tqdm(range(self.num_classes * self.num_per_class)):
-                image = images_init[idx]
-
-                image_coord, image_value = to_coordinates_and_features(image)
-                image_coord, image_value = image_coord.to(self.device), image_value.to(self.device)
-
-                if self.dist:
-                    _syn_net = self.nf_syn.module[idx]
-                else:
-                    _syn_net = self.nf_syn[idx]
-
-                optimizer = torch.optim.Adam(_syn_net.parameters(), lr=self.lr_nf_init)
+        ### Initialize Label ###
+        self.label_syn = torch.tensor([np.ones(self.num_per_class) * i for i in range(self.num_classes)], requires_grad=False, device=self.device).view(-1)  # [0,0,0, 1,1,1, ..., 9,9,9]
+        self.label_syn = self.label_syn.long()
 
-                for it in range(self.epochs_init):
-                    optimizer.zero_grad()
-                    predicted = _syn_net(image_coord)
-                    loss = criterion(predicted, image_value)
-                    loss.backward()
-                    optimizer.step()
-                total_recon_loss.append(loss.item())
+        # Select real data for initialization
+        selected = np.concatenate([np.random.permutation(indices_class[c])[:self.num_per_class] for c in range(self.num_classes)])
+        data_init = data_real[selected]
 
-            save_and_print(self.log_path, f"Average recon loss: {np.average(total_recon_loss)}")
+        # Check if there is initialized neural fields (content-addressed cache, see init_cache.py)
+        # With --distributed, the first process looks the entry up (and holds its lock), and every process fits its own shard on a miss
+        init_cache = InitCache(self.init_cache_dir, max_bytes=self.init_cache_max_gb * 2 ** 30, max_age=self.init_cache_max_age * 24 * 3600)
+        init_key, init_fields = init_cache.key(self.init_cache_fields(selected, data_init))
+        with init_cache.lock(init_key) if self.rank == 0 else contextlib.nullcontext():
+            initialized_synset_path = broadcast_object(init_cache.load(init_key) if self.rank == 0 else None)
+            if initialized_synset_path is not None:
+                save_and_print(self.log_path, f"\n Load from >>>>> {initialized_synset_path} \n")
 
-            for ch in range(self.channel):
-                images_init[:, ch] = images_init[:, ch] * self.args.std[ch] + self.args.mean[ch]
-            images_init[images_init < 0] = 0.0
-            images_init[images_init > 1] = 1.0
-            save_image(images_init, f"{self.args.save_path}/imgs/Selected_for_initialization.png", nrow=self.num_per_class)
-            del images_init
+                data = load_synset(initialized_synset_path)
+                assert len(data["params"]) == self.num_classes * self.num_per_class
+                self.nf_syn.load_stacked_params(unpack(data["params"], data["header"], indices=slice(*self.shard)))
+                del data
 
-        ### Initialize Label ###
-        self.label_syn = torch.tensor([np.ones(self.num_per_class) * i for i in range(self.num_classes)], requires_grad=False, device=self.device).view(-1)  # [0,0,0, 1,1,1, ..., 9,9,9]
-        self.label_syn = self.label_syn.long()
+            else:
+                save_and_print(self.log_path, f"\n No initialized synset >>>>> {init_cache.path(init_key)} \n")
+
+                # Fit init_chunk neural fields at once (stacked Adam), see FieldBank.fit
+                # With --decode_mem, the chunk is reduced to fit the memory ceiling and the coordinates are chunked as in decode
+                num_init = self.num_classes * self.num_per_class
+                requested = self.init_chunk if self.init_chunk > 0 else num_init
+                init_chunk = self.nf_syn.fit_chunk_size(requested, len(self.coord), self.decode_mem * 2 ** 20)
+                if init_chunk < requested:
+                    save_and_print(self.log_path, f"Warm-up training of {init_chunk} neural fields at once (decode_mem={self.decode_mem} MB)")
+                total_recon_loss = []
+                for start in tqdm(range(self.shard[0], self.shard[1], init_chunk)):
+                    stop = min(start + init_chunk, self.shard[1])
+                    indices = torch.arange(start - self.shard[0], stop - self.shard[0], device=self.device)
+                    values = self.spec.to_values(data_init[start:stop].to(self.device))
+                    recon_loss = self.nf_syn.fit(indices, self.coord, values, epochs=self.epochs_init, lr=self.lr_nf_init, target_loss=self.init_target_mse, max_bytes=self.decode_mem * 2 ** 20)
+                    total_recon_loss += recon_loss.tolist()
+                if self.world_size > 1:
+                    total_recon_loss = all_gather_rows(torch.tensor(total_recon_loss), self.shard_counts).tolist()
+
+                save_and_print(self.log_path, f"Average recon loss: {np.average(total_recon_loss)}")
+                if self.init_target_mse > 0:
+                    save_and_print(self.log_path, f"Fields reaching target recon loss {self.init_target_mse}: {np.sum(np.array(total_recon_loss) <= self.init_target_mse)}/{num_init}")
+
+                flat, header = self.pack_synset(self.nf_syn.config())
+                labels = self.label_syn.detach().to("cpu")
+                if self.rank == 0:
+                    init_cache.store(init_key, lambda path: save_packed(path, flat, header, labels), init_fields)
+                    save_and_print(self.log_path, f"Saved initialized synset at {init_cache.path(init_key)}")
+                del flat, labels
+        barrier()
+
+        if self.rank == 0:
+            self.save_selected(data_init)
+        del data_init
 
         ### Initialize Optimizer ###
-        self.optimizer = torch.optim.Adam(self.nf_syn.parameters(), lr=self.lr_nf)
+        # sparse (default): a separate Adam per field as with one Siren module per instance, see SparseFieldAdam
+        if self.nf_optim == "sparse":
+            self.optimizer = SparseFieldAdam(self.nf_syn, lr=self.lr_nf)
+        else:
+            self.optimizer = torch.optim.Adam(self.nf_syn.parameters(), lr=self.lr_nf)
         self.optim_zero_grad()
 
-        self.save(name=initialized_synset_path.split("/")[-1])
+        ### Initialize Decoded Cache ###
+        self.version = 0
+        self.decoded, self.decoded_version = {}, -1
+
+        # The random numbers consumed above depend on the init cache (hit or warm-up fit): restart the streams identically
+        # on all processes, so that they draw the same networks, batches and augmentations (see distributed.py)
+        sync_rng(vars(self.args).get("seed", 0) + 1)
+
+        self.save(name=f"init#({self.dim_in},{self.num_layers},{self.layer_size},{self.dim_out})_({self.w0_initial},{self.w0})_({self.epochs_init},{self.lr_nf_init:.0e}).pt")
         self.show_budget()
 
-    def get(self, indices=None, need_copy=False):
+    def save_selected(self, data_init):
+        # Selected real data as an image grid: a row per class for images, a row per video (voxels are not visualized)
+        if len(self.spec.grid) != 2 and self.spec.channel_dim == 1:
+            return
+        nrow = self.num_per_class
+        if self.spec.channel_dim == 2:
+            nrow = data_init.shape[1]
+            data_init = data_init.flatten(0, 1)
+        for ch in range(self.channel):
+            data_init[:, ch] = data_init[:, ch] * self.args.std[ch] + self.args.mean[ch]
+        data_init = torch.clamp(data_init, 0, 1)
+        save_image(data_init, f"{self.args.save_path}/imgs/Selected_for_initialization.png", nrow=nrow)
+
+    def build_field(self, num_instances):
+        # field backend selected with --field (see FIELDS in field_bank.py)
+        return FIELDS[self.field].from_args(self.args, num_instances, self.get_resolution())
+
+    def init_cache_fields(self, selected, values):
+        # Everything the warm-up result depends on (the version of the fitting code is added by InitCache.key)
+        return {"domain": self.spec.domain, "grid": list(self.spec.grid), "dataset": self.args.dataset, "subset": vars(self.args).get("subset"), "res": vars(self.args).get("res"), "zca": vars(self.args).get("zca", False),
+                "seed": self.args.seed, "ipc": self.ipc,
+                "num_classes": self.num_classes, "num_per_class": self.num_per_class, "selected": tensor_digest(torch.as_tensor(selected)), "values": tensor_digest(values),
+                "field": self.nf_syn.config(), "epochs_init": self.epochs_init, "lr_nf_init": self.lr_nf_init, "init_target_mse": self.init_target_mse}
+
+    def get(self, indices=None, need_copy=False, resolution=None):
         if not hasattr(indices, '__iter__'):
             indices = range(len(self.label_syn))
+        indices = to_index_tensor(indices, self.device)
 
-        images_syn = []
-        for idx in indices:
-            if self.dist:
-                _nf_syn = self.nf_syn.module[idx]
-            else:
-                _nf_syn = self.nf_syn[idx]
-
-            _image_syn = _nf_syn(self.coord).reshape(self.im_size[0], self.im_size[1], 3).permute(2, 0, 1)
-
-            if need_copy:
-                _image_syn = copy.deepcopy(_image_syn.detach())
-
-            images_syn.append(_image_syn)
-        images_syn = torch.stack(images_syn)
+        if need_copy:
+            data_syn = self.get_decoded(resolution)[indices]
+        else:
+            data_syn = self.decode(indices, resolution)
         labels_syn = self.label_syn[indices]
 
         if need_copy:
             labels_syn = copy.deepcopy(labels_syn.detach())
-        return images_syn, labels_syn
+        return data_syn, labels_syn
+
+    def decode(self, indices=None, resolution=None):
+        resolution = self.get_resolution(resolution)
+        if self.world_size == 1:
+            return self.spec.from_values(self.decode_local(indices, resolution), resolution)
+
+        # Each process decodes the requested instances of its shard, and the decoded instances are gathered in the requested order
+        if indices is None:
+            indices = torch.arange(len(self.label_syn), device=self.device)
+        starts = torch.tensor([shard_bounds(len(self.label_syn), r, self.world_size)[0] for r in range(1, self.world_size)], device=indices.device)
+        owner = torch.bucketize(indices, starts, right=True)
+        order = torch.argsort(owner, stable=True)
+        counts = torch.bincount(owner, minlength=self.world_size).tolist()
+        local = indices[order][owner[order] == self.rank] - self.shard[0]
+        if len(local) > 0:
+            values = self.decode_local(local, resolution)
+        else:
+            # still part of the graph, so that this process joins the gradient exchange in backward
+            values = torch.zeros((0, int(np.prod(resolution)), self.spec.channel), device=self.device, requires_grad=torch.is_grad_enabled())
+        values = GatherDecoded.apply(values, counts, self.rank)[torch.argsort(order)]
+        return self.spec.from_values(values, resolution)
+
+    def decode_local(self, indices, resolution):
+        # indices: instances of the shard of this process -> (len(indices), prod(resolution), channel)
+        if self.nf_optim == "sparse" and torch.is_grad_enabled():
+            # mark the decoded fields for the next step
+            self.optimizer.touch(indices)
+        return self.nf_syn(self.get_coord(resolution), indices, max_bytes=self.decode_mem * 2 ** 20, use_checkpoint=self.checkpoint_decode, dtype=self.decode_dtype)
+
+    def get_decoded(self, resolution=None):
+        # Decoded synset shared by all read-only consumers, invalidated by the optimizer step version
+        if self.decoded_version != self.version:
+            self.decoded, self.decoded_version = {}, self.version
+        resolution = self.get_resolution(resolution)
+        if resolution not in self.decoded:
+            with torch.no_grad():
+                self.decoded[resolution] = self.decode(resolution=resolution)
+        return self.decoded[resolution]
+
+    def release_decoded(self):
+        # drop the decoded synset of get_decoded, e.g. after an evaluation so that it is not alive during the next update
+        self.decoded, self.decoded_version = {}, -1
+
+    def get_resolution(self, resolution=None):
+        return self.spec.grid if resolution is None else tuple(int(r) for r in resolution)
+
+    def get_coord(self, resolution):
+        # Grid spanning the same extent as the training grid, so the fields can be sampled at any resolution
+        if resolution == self.get_resolution():
+            return self.coord
+        return coordinate_grid(resolution, self.get_resolution(), self.get_coord_norm(), self.device)
+
+    def get_coord_norm(self):
+        return self.spec.coord_norm
+
+    def broadcast(self, obj):
+        # obj of the first process, for decisions that all processes have to take together (e.g. whether to save)
+        return broadcast_object(obj)
 
     def optim_zero_grad(self):
         self.optimizer.zero_grad()
 
     def optim_step(self):
         self.optimizer.step()
+        self.version += 1
+        self.release_decoded()
 
     def show_budget(self):
         save_and_print(self.log_path, '=' * 50)
-        save_and_print(self.log_path, f"Allowed Budget Size: {self.num_classes * self.ipc * self.channel * self.im_size[0] * self.im_size[1]}")
-        save_and_print(self.log_path, f"Utilize Budget Size: {sum(sum(t.nelement() for t in tensors) for tensors in (self.nf_syn.parameters(), self.nf_syn.buffers()))}")
+        save_and_print(self.log_path, f"Allowed Budget Size: {self.num_classes * self.ipc * self.spec.numel()}")
+        save_and_print(self.log_path, f"Utilize Budget Size: {self.budget_per_instance * len(self.label_syn)}")
+        if self.world_size > 1:
+            save_and_print(self.log_path, f"Instances per process: {self.shard_counts}")
         save_and_print(self.log_path, f"Budget per instance: {self.budget_per_instance}")
-        images, _ = self.get(need_copy=True)
-        save_and_print(self.log_path, f"Decode condensed data: {images.shape}")
-        del images
-
-        start = time.time()
-        self.get(indices=[0])
-        single_time = time.time() - start
-        start = time.time()
-        self.get(indices=[0], need_copy=True)
-        single_time_copy = time.time() - start
-        save_and_print(self.log_path, f"Single instance retrieval time: {single_time:.5f} {single_time_copy:.5f}")
+        if self.decode_mem > 0:
+            save_and_print(self.log_path, f"Decode memory ceiling: {self.decode_mem} MB ({self.nf_syn.chunk_size(min(self.num_per_class, self.nf_syn.num_instances), len(self.coord), self.decode_mem * 2 ** 20)}/{len(self.coord)} coordinates per chunk for a class)")
+
+        # Memory/compute trade-off of activation checkpointing for a single instance
+        saved, elapsed = measure_decode(self.nf_syn, self.coord, to_index_tensor([0], self.device), max_bytes=self.decode_mem * 2 ** 20, dtype=self.decode_dtype)
+        saved_ckpt, elapsed_ckpt = measure_decode(self.nf_syn, self.coord, to_index_tensor([0], self.device), max_bytes=self.decode_mem * 2 ** 20, use_checkpoint=True, dtype=self.decode_dtype)
+        save_and_print(self.log_path, f"Decode per instance (forward+backward): stored {saved / 2 ** 20:.2f} MB, {elapsed:.5f}s / checkpointed {saved_ckpt / 2 ** 20:.2f} MB, {elapsed_ckpt:.5f}s (checkpoint_decode={self.checkpoint_decode})")
+
+        # Error of the reduced precision decode against fp32 for the instances of the first class
+        if self.decode_dtype is not None:
+            with torch.no_grad():
+                indices = to_index_tensor(range(min(self.num_per_class, self.nf_syn.num_instances)), self.device)
+                decoded = self.nf_syn(self.coord, indices, max_bytes=self.decode_mem * 2 ** 20)
+                decoded_low = self.nf_syn(self.coord, indices, max_bytes=self.decode_mem * 2 ** 20, dtype=self.decode_dtype)
+            max_error = (decoded_low - decoded).abs().max().item()
+            tolerance = DECODE_DTYPE_TOLERANCE[self.args.decode_dtype]
+            save_and_print(self.log_path, f"Decode error of {self.args.decode_dtype} against fp32: MSE {((decoded_low - decoded) ** 2).mean().item():.3e}, max abs {max_error:.3e} (tolerance {tolerance:.0e})")
+            if not self.broadcast(max_error <= tolerance): # the first process decides for all
+                save_and_print(self.log_path, f"Decode error of {self.args.decode_dtype} exceeds the tolerance, fallback to fp32 decode")
+                self.decode_dtype = None
+            del decoded, decoded_low
+        data_syn, _ = self.get(need_copy=True)
+        save_and_print(self.log_path, f"Decode condensed data: {data_syn.shape} (decode throughput over batch sizes: SynSet/benchmark_synset.py)")
+        del data_syn
         save_and_print(self.log_path, '=' * 50)
 
+    def pack_synset(self, field):
+        # Packed parameters of all instances, gathered from the shards of all processes with --distributed
+        flat, header = pack(self.nf_syn.state_dict_keys(), self.nf_syn.stacked_params(), field=field)
+        if self.world_size > 1:
+            flat = all_gather_rows(flat, self.shard_counts)
+        return flat, header
+
+    def data_stats(self):
+        # Normalization of the real data the synset is distilled against, for exporting decoded data (see export_synset.py)
+        stats = {"mean": [float(m) for m in self.args.mean], "std": [float(s) for s in self.args.std], "zca": None}
+        zca = vars(self.args).get("zca_trans")
+        if vars(self.args).get("zca", False) and zca is not None:
+            stats["zca"] = {k: getattr(zca, k).detach().to("cpu") for k in ["mean_vector", "transform_matrix", "transform_inv"]}
+        return stats
+
     def save(self, name, auxiliary=None):
-        nf_syn_save = []
-        for idx in range(len(self.label_syn)):
-            if self.dist:
-                _nf_syn = self.nf_syn.module[idx]
-            else:
-                _nf_syn = self.nf_syn[idx]
-            nf_syn_save.append({k: copy.deepcopy(v.to("cpu")) for k, v in _nf_syn.state_dict().items()})
         labels_syn_save = copy.deepcopy(self.label_syn.detach().to("cpu"))
-
-        save_data = {"nf": nf_syn_save, "label": labels_syn_save}
-        if type(auxiliary) == dict:
-            save_data.update(auxiliary)
-        torch.save(save_data, f"{self.args.save_path}/{name}")
+        auxiliary = dict(auxiliary or {}, data=self.data_stats())
+
+        field = dict(self.nf_syn.config(), resolution=list(self.get_resolution()), coord_norm=list(self.get_coord_norm()), channel_dim=self.spec.channel_dim)
+        if self.save_format == "packed":
+            flat, header = self.pack_synset(field)
+            if self.rank == 0:
+                save_packed(f"{self.args.save_path}/{name}", flat, header, labels_syn_save, auxiliary)
+            del flat
+        elif self.world_size > 1:
+            flat, header = self.pack_synset(field)
+            if self.rank == 0:
+                save_data = to_legacy({"params": flat, "header": header, "label": labels_syn_save}) # with the field config
+                if type(auxiliary) == dict:
+                    save_data.update(auxiliary)
+                torch.save(save_data, f"{self.args.save_path}/{name}")
+            del flat
+        else:
+            nf_syn_save = self.nf_syn.state_dicts()
+            save_data = {"nf": nf_syn_save, "label": labels_syn_save, "field": field} # field config for SynsetDecoder
+            if type(auxiliary) == dict:
+                save_data.update(auxiliary)
+            torch.save(save_data, f"{self.args.save_path}/{name}")
+            del nf_syn_save, save_data
         save_and_print(self.log_path, f"Saved at {self.args.save_path}/{name}")
-        del nf_syn_save, labels_syn_save, save_data
-
-# Below code adapted from
-# https://github.com/lucidrains/siren-pytorch
-
-def to_coordinates_and_features(img):
-    coordinates = torch.ones(img.shape[1:]).nonzero(as_tuple=False).float()
-    coordinates = coordinates / (img.shape[1] - 1) - 0.5
-    coordinates *= 2
-    features = img.reshape(img.shape[0], -1).T
-    return coordinates, features
-
-class Sine(nn.Module):
-    def __init__(self, w0=1.):
-        super().__init__()
-        self.w0 = w0
-
-    def forward(self, x):
-        return torch.sin(self.w0 * x)
-
-
-class SirenLayer(nn.Module):
-    def __init__(self, dim_in, dim_out, w0=30., c=6., is_first=False,
-                 use_bias=True, activation=None):
-        super().__init__()
-        self.dim_in = dim_in
-        self.is_first = is_first
-
-        self.linear = nn.Linear(dim_in, dim_out, bias=use_bias)
-
-        w_std = (1 / dim_in) if self.is_first else (sqrt(c / dim_in) / w0)
-        nn.init.uniform_(self.linear.weight, -w_std, w_std)
-        if use_bias:
-            nn.init.uniform_(self.linear.bias, -w_std, w_std)
-
-        self.activation = Sine(w0) if activation is None else activation
-
-    def forward(self, x):
-        out = self.linear(x)
-        out = self.activation(out)
-        return out
-
-
-class Siren(nn.Module):
-    def __init__(self, dim_in, dim_hidden, dim_out, num_layers, w0=30.,
-                 w0_initial=30., use_bias=True, final_activation=None):
-        super().__init__()
-        layers = []
-        for ind in range(num_layers):
-            is_first = ind == 0
-            layer_w0 = w0_initial if is_first else w0
-            layer_dim_in = dim_in if is_first else dim_hidden
-
-            layers.append(SirenLayer(
-                dim_in=layer_dim_in,
-                dim_out=dim_hidden,
-                w0=layer_w0,
-                use_bias=use_bias,
-                is_first=is_first
-            ))
-
-        self.net = nn.Sequential(*layers)
-
-        final_activation = nn.Identity() if final_activation is None else final_activation
-        self.last_layer = SirenLayer(dim_in=dim_hidden, dim_out=dim_out, w0=w0,
-                                use_bias=use_bias, activation=final_activation)
-
-    def forward(self, x):
-        x = self.net(x)
-        return self.last_layer(x)
+        del labels_syn_save
@@ -1 +1,7 @@
-from .DDiF import DDiF, to_coordinates_and_features, Siren
\ No newline at end of file
+from .DDiF import DDiF, ShapeSpec
+from .field_bank import SirenBank, HashGridBank, FourierMLPBank, FIELDS, register_field, build_field
+from .synset_io import SynsetDecoder, load_subset
+from .export_synset import SynsetShards
+from .res_schedule import ResSchedule, resize
+from .distributed import init_distributed, is_main, barrier, broadcast_object, sync_rng
+from .arguments import add_synset_args
\ No newline at end of file
@@ -0,0 +1,35 @@
+try:
+    from .field_bank import FIELDS
+except ImportError: # run as a script from SynSet/
+    from field_bank import FIELDS
+
+# Command line options of the synthetic set shared by all entry points (DC, DM, TM, Video and 3D_Voxel).
+# The field hyperparameters (--dim_in, --layer_size, ...) and --lr_nf stay in the entry points, since their defaults
+# come from the hyper_params.py of each pipeline.
+
+
+def add_synset_args(parser, res_schedule=True, distributed=False):
+    # res_schedule: the entry point decodes at a coarse-to-fine resolution schedule (see res_schedule.py)
+    # distributed: the entry point shards the synthetic set over torchrun processes (see distributed.py)
+    parser.add_argument('--init_chunk', type=int, default=256, help='number of neural fields fitted at once in warm-up training (0 means all)')
+    parser.add_argument('--init_target_mse', type=float, default=0.0, help='stop warm-up training of a neural field once its recon loss reaches this value (0 means no early stopping)')
+    parser.add_argument('--decode_mem', type=float, default=0, help='memory ceiling (MB) for activations when decoding neural fields, decoded in coordinate chunks (0 means no chunking)')
+    parser.add_argument('--checkpoint_decode', action='store_true', help='recompute neural field activations in backward instead of storing them')
+    parser.add_argument('--decode_dtype', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='compute precision of the neural field decode (parameters stay in fp32)')
+    parser.add_argument('--compile_decode', action='store_true', help='decode neural fields with torch.compile (falls back to eager if compilation fails)')
+    parser.add_argument('--save_format', type=str, default='legacy', choices=['legacy', 'packed'], help='synset checkpoint format (packed: one contiguous memory-mappable parameter tensor)')
+    parser.add_argument('--init_cache_dir', type=str, default='../initialized_synset', help='cache of warm-up initialized synsets (see SynSet/init_cache.py)')
+    parser.add_argument('--init_cache_max_gb', type=float, default=0, help='size limit of the init cache in GB (0 means unlimited)')
+    parser.add_argument('--init_cache_max_age', type=float, default=0, help='entries of the init cache unused for this many days are evicted (0 means never)')
+    parser.add_argument('--nf_optim', type=str, default='sparse', choices=['sparse', 'dense'], help='sparse: Adam per neural field, steps only the fields decoded since the last step with their own step counts (as a separate Adam per field); dense: one Adam over the stacked parameters, which also moves fields outside the batch')
+    if res_schedule:
+        parser.add_argument('--res_schedule', type=str, default='', help='coarse-to-fine resolution schedule "it:res,...", e.g. "0:32,5000:64,10000:128" (empty: native resolution)')
+    parser.add_argument('--field', type=str, default='siren', choices=sorted(FIELDS), help='neural field backend of a synthetic instance (see SynSet/field_bank.py)')
+    parser.add_argument('--hash_levels', type=int, default=2, help='hashgrid: number of grid levels')
+    parser.add_argument('--hash_features', type=int, default=2, help='hashgrid: features per grid vertex')
+    parser.add_argument('--hash_table_size', type=int, default=0, help='hashgrid: entries per level (0: same budget per instance as the SIREN of layer_size and num_layers)')
+    parser.add_argument('--fourier_features', type=int, default=16, help='fourier_mlp: number of frequencies')
+    parser.add_argument('--fourier_scale', type=float, default=10., help='fourier_mlp: standard deviation of the initial frequencies')
+    if distributed:
+        parser.add_argument('--distributed', action='store_true', help='shard the storage and decoding of the synthetic set over the processes of torchrun (gloo backend); every process runs the full matching loss and evaluation, so this saves memory, not time (see SynSet/distributed.py)')
+    return parser
@@ -0,0 +1,82 @@
+import os
+import time
+import argparse
+import importlib.util
+import torch
+
+from field_bank import SirenBank, coordinate_grid
+
+# Microbenchmark of eager vs. compiled (torch.compile) decode of the synthetic neural fields
+# for every configuration in the hyper_params.py of each pipeline.
+# Run directly, e.g. python SynSet/benchmark_decode.py --device cpu
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+PIPELINES = {"DC": 3, "DM": 3, "TM": 3, "3D_Voxel": 1, "Video": 3} # pipeline: channel
+VIDEO_SIZE = {"miniUCF101": (16, 112, 112)}
+
+
+def load_hyper_params(pipeline):
+    spec = importlib.util.spec_from_file_location(f"hyper_params_{pipeline}", os.path.join(ROOT, pipeline, "hyper_params.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def configurations(pipelines):
+    for pipeline in pipelines:
+        hp = load_hyper_params(pipeline)
+        for key in hp.LAYER_SIZE:
+            for ipc in hp.LAYER_SIZE[key]:
+                dim_in = hp.DIM_IN[key][ipc]
+                size = VIDEO_SIZE[key] if pipeline == "Video" else (int(key.split("_")[-1]),) * dim_in
+                yield pipeline, key, ipc, PIPELINES[pipeline], size, dict(dim_in=dim_in, num_layers=hp.NUM_LAYERS[key][ipc], dim_hidden=hp.LAYER_SIZE[key][ipc],
+                                                                          dim_out=hp.DIM_OUT[key][ipc], w0_initial=hp.W0_INITIAL[key][ipc], w0=hp.W0[key][ipc])
+
+
+def timeit(fn, repeat, device):
+    fn() # warm-up (compilation happens here)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat
+
+
+def main(args):
+    device = torch.device(args.device)
+    print(f"{'pipeline':<9} {'config':<14} {'ipc':>3} {'fields':>6} {'eager fwd':>10} {'comp fwd':>10} {'eager f+b':>10} {'comp f+b':>10} {'speedup':>8}  compile")
+    for pipeline, key, ipc, channel, size, cfg in configurations(args.pipelines):
+        budget_per_instance = sum(p.nelement() for p in SirenBank(num_instances=1, **cfg).parameters())
+        num_instances = args.instances if args.instances > 0 else max(1, int(ipc * channel * torch.tensor(size).prod().item() / budget_per_instance))
+        bank = SirenBank(num_instances=num_instances, **cfg).to(device)
+        coord = coordinate_grid(size, size, (size[0] - 1,) * len(size) if pipeline != "Video" else (size[0] - 1, size[1] - 1, size[1] - 1), device)
+
+        def forward():
+            with torch.no_grad():
+                bank(coord)
+
+        def forward_backward():
+            torch.autograd.grad(bank(coord).sum(), list(bank.parameters()))
+
+        eager = [timeit(forward, args.repeat, device), timeit(forward_backward, args.repeat, device)]
+        compiled, reason = bank.compile_decode(coord)
+        if compiled:
+            comp = [timeit(forward, args.repeat, device), timeit(forward_backward, args.repeat, device)]
+            speedup = f"{eager[1] / comp[1]:.2f}x"
+        else:
+            comp, speedup = [float("nan")] * 2, "-"
+        print(f"{pipeline:<9} {key:<14} {ipc:>3} {num_instances:>6} {eager[0]:>10.5f} {comp[0]:>10.5f} {eager[1]:>10.5f} {comp[1]:>10.5f} {speedup:>8}  {reason}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode Benchmark')
+    parser.add_argument('--pipelines', type=str, nargs='+', default=list(PIPELINES), choices=list(PIPELINES))
+    parser.add_argument('--instances', type=int, default=0, help='number of decoded fields (0 means the fields of one class under the budget)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    main(args)
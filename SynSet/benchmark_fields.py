@@ -0,0 +1,86 @@
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+from field_bank import SirenBank, HashGridBank, coordinate_grid
+from benchmark_decode import timeit
+
+# Benchmark of the neural field backends at equal budget per instance: decode throughput (forward and forward+backward)
+# and reconstruction quality after fitting the same targets with FieldBank.fit, at the learning rate of the warm-up
+# training of DDiF.init (--lr_nf_init) for every backend.
+# The targets are smooth random images (upsampled noise), or a .pt tensor (N, C, H, W) in [0, 1] given by --target.
+# Run directly, e.g. python SynSet/benchmark_fields.py --res 32 --layer_size 20 --num_layers 2
+
+
+def make_targets(args, device):
+    if args.target:
+        images = torch.load(args.target, map_location="cpu")[:args.num_instances].float()
+    else:
+        images = F.interpolate(torch.rand(args.num_instances, args.channel, 8, 8), size=(args.res, args.res), mode="bicubic", align_corners=True)
+        images = (images + 0.1 * torch.rand(args.num_instances, args.channel, args.res, args.res)).clamp(0, 1)
+    return images.to(device).reshape(len(images), images.shape[1], -1).transpose(1, 2)
+
+
+def benchmark(name, bank, coord, values, args, device):
+    indices = torch.arange(bank.num_instances, device=device)
+    budget = sum(p.nelement() for p in bank.parameters()) // bank.num_instances
+
+    def forward():
+        with torch.no_grad():
+            bank(coord, indices)
+
+    def forward_backward():
+        bank(coord, indices).sum().backward()
+
+    elapsed = timeit(forward, args.repeat, device)
+    elapsed_backward = timeit(forward_backward, args.repeat, device)
+    bank.zero_grad(set_to_none=True)
+
+    start = time.time()
+    recon_loss = bank.fit(indices, coord, values, epochs=args.epochs, lr=args.lr_nf_init)
+    fit_time = time.time() - start
+    psnr = (10 * torch.log10(1 / recon_loss)).mean().item()
+    points = bank.num_instances * len(coord)
+    print(f"{name:8s} budget {budget:6d}  decode {points / elapsed / 1e6:8.2f} Mpts/s  forward+backward {points / elapsed_backward / 1e6:8.2f} Mpts/s  "
+          f"fit {fit_time:6.1f}s  MSE {recon_loss.mean().item():.3e}  PSNR {psnr:.2f} dB")
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    values = make_targets(args, device)
+    channel = values.shape[-1]
+    coord = coordinate_grid((args.res, args.res), (args.res, args.res), (args.res - 1, args.res - 1), device)
+
+    siren = SirenBank(num_instances=args.num_instances, dim_in=2, dim_hidden=args.layer_size, dim_out=channel, num_layers=args.num_layers, w0_initial=args.w0_initial, w0=args.w0).to(device)
+    siren_budget = sum(p.nelement() for p in siren.parameters()) // args.num_instances
+    table_size = HashGridBank.table_size_for_budget(siren_budget, 2, args.layer_size, channel, args.hash_levels, args.hash_features, 4, args.res)
+    hashgrid = HashGridBank(num_instances=args.num_instances, dim_in=2, dim_hidden=args.layer_size, dim_out=channel, levels=args.hash_levels, features=args.hash_features,
+                            table_size=table_size, base_res=4, max_res=args.res).to(device)
+
+    print(f"{args.num_instances} instances of {channel}x{args.res}x{args.res}, hashgrid levels {hashgrid.resolutions} with {table_size} entries")
+    benchmark("siren", siren, coord, values, args, device)
+    benchmark("hashgrid", hashgrid, coord, values, args, device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Neural Field Benchmark')
+    parser.add_argument('--num_instances', type=int, default=100)
+    parser.add_argument('--channel', type=int, default=3)
+    parser.add_argument('--res', type=int, default=32)
+    parser.add_argument('--target', type=str, default='', help='.pt tensor (N, C, H, W) in [0, 1] (default: smooth random images)')
+    parser.add_argument('--layer_size', type=int, default=20)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--w0_initial', type=float, default=30.)
+    parser.add_argument('--w0', type=float, default=30.)
+    parser.add_argument('--hash_levels', type=int, default=2)
+    parser.add_argument('--hash_features', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=5000)
+    parser.add_argument('--lr_nf_init', type=float, default=5e-4, help='learning rate of the fit of every backend (as --lr_nf_init of the entry points)')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    main(args)
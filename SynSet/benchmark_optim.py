@@ -0,0 +1,76 @@
+import time
+import argparse
+import torch
+
+from field_bank import SirenBank, SparseFieldAdam, coordinate_grid
+
+# Benchmark of dense Adam vs. SparseFieldAdam on a DC/DM-like loop, where every step decodes batch_syn fields of each class.
+# Both optimizers start from the same fields and see the same batches. The two trajectories differ by design as soon
+# as a field is skipped by a batch: dense Adam moves it anyway (zero gradient, remaining momentum) and counts one step
+# for all fields, SparseFieldAdam leaves it as it is and keeps a step count per field (as a separate Adam per field,
+# which is checked by tests/test_field_bank_optim.py). The difference is reported to show how far apart they end up.
+# Run directly, e.g. python SynSet/benchmark_optim.py --num_per_class 500 --batch_syn 10
+
+
+def run(bank, optimizer, coord, batches, sparse, device):
+    elapsed = 0.
+    for indices in batches:
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.time()
+        if sparse:
+            optimizer.touch(indices)
+        loss = (bank(coord, indices) ** 2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed += time.time() - start
+    return elapsed / len(batches)
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    cfg = dict(dim_in=2, dim_hidden=args.layer_size, dim_out=3, num_layers=args.num_layers, w0_initial=30., w0=args.w0)
+    num_instances = args.num_classes * args.num_per_class
+    coord = coordinate_grid((args.res, args.res), (args.res, args.res), (args.res - 1, args.res - 1), device)
+
+    batches = []
+    for _ in range(args.steps):
+        batches.append(torch.cat([c * args.num_per_class + torch.randperm(args.num_per_class)[:args.batch_syn] for c in range(args.num_classes)]).to(device))
+
+    dense_bank = SirenBank(num_instances=num_instances, **cfg).to(device)
+    sparse_bank = SirenBank(num_instances=num_instances, **cfg).to(device)
+    sparse_bank.load_state_dict(dense_bank.state_dict())
+
+    dense = run(dense_bank, torch.optim.Adam(dense_bank.parameters(), lr=args.lr), coord, batches, False, device)
+    sparse = run(sparse_bank, SparseFieldAdam(sparse_bank, lr=args.lr), coord, batches, True, device)
+
+    outside = torch.ones(num_instances, dtype=torch.bool, device=device)
+    outside[batches[-1]] = False
+    diff = max((p - q)[~outside].abs().max().item() for p, q in zip(dense_bank.parameters(), sparse_bank.parameters()))
+    diff_outside = max((p - q)[outside].abs().max().item() for p, q in zip(dense_bank.parameters(), sparse_bank.parameters())) if outside.any() else 0.
+    print(f"{num_instances} fields ({args.num_classes} classes x {args.num_per_class}), {args.batch_syn} decoded per class, {args.steps} steps")
+    print(f"dense Adam  {dense:.5f}s/step")
+    print(f"sparse Adam {sparse:.5f}s/step ({dense / sparse:.2f}x)")
+    print(f"max abs parameter difference sparse vs. dense (expected, not an equivalence check): {diff:.3e} (last batch), {diff_outside:.3e} (outside the last batch)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Optimizer Benchmark')
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--num_per_class', type=int, default=500, help='fields per class (large ipc)')
+    parser.add_argument('--batch_syn', type=int, default=10, help='fields decoded per class and step')
+    parser.add_argument('--layer_size', type=int, default=20)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--w0', type=float, default=10.)
+    parser.add_argument('--res', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=1e-5)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    main(args)
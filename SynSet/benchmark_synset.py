@@ -0,0 +1,107 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import torch
+
+from field_bank import SirenBank, coordinate_grid
+from benchmark_decode import configurations, timeit, PIPELINES
+
+# Decode benchmark suite of the synset engine: forward and forward+backward decode throughput over batch sizes,
+# for the field configuration of every entry of the hyper_params.py of each pipeline (image, video and voxel).
+# A decode is FieldBank.forward followed by the reshape to the layout of the domain, as in DDiF.decode.
+# Results are written as JSON; with --baseline, the throughput is compared against a stored result and the run
+# fails (exit code 1) if any case is slower by more than --tolerance.
+#   python SynSet/benchmark_synset.py --output baseline.json
+#   python SynSet/benchmark_synset.py --output current.json --baseline baseline.json --tolerance 0.1
+
+
+def layout(pipeline):
+    # channel axis of a decoded batch (see the ShapeSpec of each DDiF)
+    return 2 if pipeline == "Video" else 1
+
+
+def run_case(pipeline, cfg, size, batch, args, device):
+    bank = SirenBank(num_instances=batch, **cfg).to(device)
+    coord = coordinate_grid(size, size, (size[0] - 1, size[1] - 1, size[1] - 1) if pipeline == "Video" else (size[0] - 1,) * len(size), device)
+    params = list(bank.parameters())
+
+    def decode():
+        values = bank(coord, max_bytes=args.decode_mem * 2 ** 20, use_checkpoint=args.checkpoint)
+        return values.reshape(-1, *size, cfg["dim_out"]).movedim(-1, layout(pipeline)).contiguous()
+
+    def forward():
+        with torch.no_grad():
+            decode()
+
+    def forward_backward():
+        torch.autograd.grad(decode().sum(), params)
+
+    forward_s = timeit(forward, args.repeat, device)
+    backward_s = timeit(forward_backward, args.repeat, device)
+    pixels = batch * len(coord)
+    return {"forward_ms": forward_s * 1000, "forward_backward_ms": backward_s * 1000,
+            "forward_instances_per_s": batch / forward_s, "forward_pixels_per_s": pixels / forward_s,
+            "forward_backward_instances_per_s": batch / backward_s, "forward_backward_pixels_per_s": pixels / backward_s}
+
+
+def compare(results, baseline, tolerance):
+    # cases whose throughput dropped by more than tolerance (relative) against the baseline
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ["forward_pixels_per_s", "forward_backward_pixels_per_s"]:
+            ratio = result[metric] / baseline[name][metric]
+            print(f"{name:<40} {metric:<32} {ratio:>6.2f}x{'  REGRESSION' if ratio < 1 - tolerance else ''}")
+            if ratio < 1 - tolerance:
+                regressions.append((name, metric, ratio))
+    return regressions
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    results = {}
+    print(f"{'case':<40} {'fwd ms':>9} {'f+b ms':>9} {'fwd inst/s':>11} {'f+b inst/s':>11} {'fwd Mpix/s':>11} {'f+b Mpix/s':>11}")
+    for pipeline, key, ipc, channel, size, cfg in configurations(args.pipelines):
+        for batch in args.batch_sizes:
+            name = f"{pipeline}/{key}/ipc{ipc}/batch{batch}"
+            result = run_case(pipeline, cfg, size, batch, args, device)
+            results[name] = dict(result, pipeline=pipeline, config=key, ipc=ipc, batch=batch, field=cfg, grid=list(size))
+            print(f"{name:<40} {result['forward_ms']:>9.3f} {result['forward_backward_ms']:>9.3f} {result['forward_instances_per_s']:>11.1f} {result['forward_backward_instances_per_s']:>11.1f} "
+                  f"{result['forward_pixels_per_s'] / 1e6:>11.2f} {result['forward_backward_pixels_per_s'] / 1e6:>11.2f}")
+
+    if args.output:
+        meta = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "device": str(device), "torch": torch.__version__, "threads": torch.get_num_threads(),
+                "platform": platform.platform(), "decode_mem": args.decode_mem, "checkpoint": args.checkpoint, "repeat": args.repeat}
+        with open(args.output, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=1)
+        print(f"Saved at {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nComparison against {args.baseline} ({baseline['meta']['device']}, torch {baseline['meta']['torch']})")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} decode regressions beyond {args.tolerance:.0%}")
+            sys.exit(1)
+        print("No decode regression")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synset Decode Benchmark Suite')
+    parser.add_argument('--pipelines', type=str, nargs='+', default=list(PIPELINES), choices=list(PIPELINES))
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 64], help='number of decoded instances')
+    parser.add_argument('--decode_mem', type=float, default=1024, help='decode memory ceiling in MB (0 means unlimited)')
+    parser.add_argument('--checkpoint', action='store_true', help='activation checkpointing of the decode')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', type=str, default='', help='JSON file of the results')
+    parser.add_argument('--baseline', type=str, default='', help='JSON file of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative throughput drop counted as a regression')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,27 @@
+import argparse
+import torch
+
+from synset_io import load_synset, to_legacy, save_packed
+
+# Conversion between the legacy {"nf": [...], "label": ...} synset checkpoint and the packed format of synset_io.py
+# e.g. python SynSet/convert_synset.py DDiF_DC_10ipc#synset_best.pt DDiF_DC_10ipc#synset_best_packed.pt --to packed
+
+
+def main(args):
+    data = load_synset(args.src, mmap=False)
+    if args.to == "packed":
+        auxiliary = {k: v for k, v in data.items() if k not in ["format", "params", "header", "label", "field"]}
+        save_packed(args.dst, data["params"], data["header"], data["label"], auxiliary)
+    else:
+        torch.save(to_legacy(data), args.dst)
+    print(f"{args.src} -> {args.dst} ({args.to}, {len(data['params'])} instances, {data['params'].shape[1]} parameters per instance)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synset Checkpoint Conversion')
+    parser.add_argument('src', type=str, help='synset checkpoint (legacy or packed)')
+    parser.add_argument('dst', type=str, help='converted synset checkpoint')
+    parser.add_argument('--to', type=str, default='packed', choices=['packed', 'legacy'])
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,101 @@
+import random
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# Synthetic set sharded over the processes of a torchrun launch (gloo backend, so it runs on CPU nodes as well).
+# Only the fields are sharded: instance i belongs to the process whose shard [start, stop) contains it, and only that
+# process stores, decodes, backpropagates and steps its field. Decoded instances are exchanged with all_gather.
+# Everything else is replicated: every process runs the full network, matching loss and evaluation on all requested
+# instances, so the mode divides the memory of the synthetic set by the number of processes, not the time of an
+# iteration (the processes of a node share its CPU threads and each one runs the whole loop).
+# For that to be the single objective of a single-process run, the processes keep the same random streams: every
+# process draws the initialization of all fields and keeps its rows (see build_shard), the streams are reseeded
+# identically after the warm-up (see DDiF.init) and the DSA seed is broadcast, so they draw the same networks,
+# batches and augmentations.
+# The gradient w.r.t. the decoded instances is then the same on all processes; it is averaged anyway, so that
+# nondeterministic kernels cannot make the shards step on slightly different objectives.
+#   torchrun --nproc_per_node 8 main_DM.py ... --distributed
+#   torchrun --nnodes 2 --node_rank 0 --master_addr host0 --master_port 29500 --nproc_per_node 8 main_DM.py ... --distributed
+
+
+def init_distributed(args):
+    args.rank, args.world_size = 0, 1
+    if not args.distributed:
+        return
+    dist.init_process_group(backend="gloo")
+    args.rank, args.world_size = dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def is_main(args):
+    return vars(args).get("rank", 0) == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    # obj of process src on all processes, e.g. a decision that has to be taken collectively
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def sync_rng(seed):
+    # same torch, numpy and random streams on all processes (called with the same seed everywhere)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def shard_bounds(num_instances, rank, world_size):
+    # contiguous shards whose sizes differ by at most one
+    return num_instances * rank // world_size, num_instances * (rank + 1) // world_size
+
+
+def build_shard(build, num_instances, shard):
+    # build(num_instances) -> FieldBank; rows [start, stop) of the bank of all instances. Every process draws the
+    # initialization of all instances from the same random numbers, so the initial fields (and the random numbers left
+    # for what follows) do not depend on the number of processes
+    bank = build(num_instances)
+    if tuple(shard) == (0, num_instances):
+        return bank
+    with torch.random.fork_rng(devices=[]):
+        local = build(shard[1] - shard[0])
+    local.load_stacked_params([p[shard[0]:shard[1]] for p in bank.stacked_params()])
+    return local
+
+
+def all_gather_rows(x, counts):
+    # rows (counts[r], ...) of every process r, concatenated in the order of the processes (gloo exchanges CPU tensors)
+    padded = torch.zeros((max(counts), *x.shape[1:]), dtype=x.dtype)
+    padded[:len(x)] = x.detach().to("cpu")
+    gathered = [torch.empty_like(padded) for _ in counts]
+    dist.all_gather(gathered, padded)
+    return torch.cat([g[:c] for g, c in zip(gathered, counts)]).to(x.device)
+
+
+class GatherDecoded(torch.autograd.Function):
+    # forward: rows decoded by each process -> rows of all processes
+    # backward: gradient of all rows averaged over the processes (the same objective on all of them) -> gradient of the local rows
+    @staticmethod
+    def forward(ctx, local, counts, rank):
+        ctx.counts, ctx.rank = counts, rank
+        return all_gather_rows(local, counts)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad_cpu = grad.detach().to("cpu", copy=True).contiguous()
+        dist.all_reduce(grad_cpu)
+        grad_cpu /= dist.get_world_size()
+        start = sum(ctx.counts[:ctx.rank])
+        return grad_cpu[start:start + ctx.counts[ctx.rank]].to(grad.device), None, None
@@ -0,0 +1,146 @@
+import os
+import json
+import argparse
+import numpy as np
+import torch
+
+try:
+    from .synset_io import SynsetDecoder
+    from .res_schedule import resize
+except ImportError: # run as a script from SynSet/
+    from synset_io import SynsetDecoder
+    from res_schedule import resize
+
+# Export of a saved synset as decoded data for downstream training, and the matching Dataset.
+#   {out}/shard_{k:05d}.npy  decoded instances [start, start + count) in the layout of the domain, e.g. (count, C, H, W)
+#   {out}/labels.npy         label of every instance (int64)
+#   {out}/index.json         shards, shape, dtype, normalization (mean, std) and how the data was produced
+# The instances are decoded in batches (bounded memory) and written into memory-mapped .npy files. With ZCA, the
+# whitening is inverted with the statistics stored in the checkpoint (DDiF.data_stats); they only apply at the training
+# resolution, so with another --resolution the instances are decoded at the training resolution, inverted and resized.
+# With --uint8, the data is de-normalized to [0, 1] and quantized, and SynsetShards normalizes it back with the stored
+# mean and std.
+# e.g. python SynSet/export_synset.py DDiF_DC_10ipc#synset_best.pt exported/ --uint8 --shard_size 10000
+
+INDEX = "index.json"
+
+
+def invert_zca(x, zca):
+    # inverse of kornia.enhance.ZCAWhitening (inverse_transform) on flattened instances
+    mean_inv = -zca["mean_vector"].to(x.device).mm(zca["transform_matrix"].to(x.device))
+    return (x.reshape(len(x), -1) - mean_inv).mm(zca["transform_inv"].to(x.device)).reshape(x.shape)
+
+
+def channel_shape(channel, channel_dim, ndim):
+    # shape broadcasting per-channel statistics over a batch with ndim dimensions
+    shape = [1] * ndim
+    shape[channel_dim] = channel
+    return shape
+
+
+def export(args):
+    decoder = SynsetDecoder(args.src, device=args.device, field=json.loads(args.field) if args.field else None)
+    stats = decoder.auxiliary.get("data") or {}
+    mean = args.mean if args.mean is not None else stats.get("mean")
+    std = args.std if args.std is not None else stats.get("std")
+    zca = stats.get("zca") if not args.no_zca else None
+    assert not args.uint8 or (mean is not None and std is not None), "uint8 export needs the mean and std of the data (--mean/--std for checkpoints without them)"
+
+    os.makedirs(args.dst, exist_ok=True)
+    channel_dim = decoder.field.get("channel_dim", 1)
+    dtype = np.uint8 if args.uint8 else np.dtype(args.dtype)
+    num_instances = len(decoder)
+    # the ZCA statistics are those of the training resolution: invert there, then resize
+    zca_resize = zca is not None and args.resolution is not None and list(args.resolution) != list(decoder.field["resolution"])
+    shards, shard, shape = [], None, None
+    for start in range(0, num_instances, args.batch_size):
+        indices = range(start, min(start + args.batch_size, num_instances))
+        x, _ = decoder.get(indices, resolution=None if zca_resize else args.resolution, max_bytes=args.decode_mem * 2 ** 20)
+        if zca is not None:
+            x = invert_zca(x, zca)
+        if zca_resize:
+            x = resize(x, args.resolution, channel_dim)
+        if args.uint8:
+            bcast = channel_shape(x.shape[channel_dim], channel_dim, x.dim())
+            x = x * torch.tensor(std, device=x.device).view(bcast) + torch.tensor(mean, device=x.device).view(bcast)
+            x = (x.clamp(0, 1) * 255).round()
+        x = x.to("cpu").numpy().astype(dtype)
+        shape = list(x.shape[1:])
+
+        # write the batch row by row into the shards it overlaps
+        for i in range(len(x)):
+            idx = start + i
+            if idx % args.shard_size == 0:
+                count = min(args.shard_size, num_instances - idx)
+                name = f"shard_{idx // args.shard_size:05d}.npy"
+                shard = np.lib.format.open_memmap(os.path.join(args.dst, name), mode="w+", dtype=dtype, shape=(count, *shape))
+                shards.append({"file": name, "start": idx, "count": count})
+            shard[idx % args.shard_size] = x[i]
+        print(f"{min(start + args.batch_size, num_instances)}/{num_instances}", end="\r")
+    del shard
+
+    labels = decoder.label.to("cpu").long().numpy()
+    np.save(os.path.join(args.dst, "labels.npy"), labels)
+    index = {"num_instances": num_instances, "shape": shape, "dtype": np.dtype(dtype).name, "shards": shards, "channel_dim": channel_dim,
+             "uint8": args.uint8, "mean": mean, "std": std, "zca_inverted": zca is not None, "source": os.path.abspath(args.src),
+             "resolution": list(args.resolution) if args.resolution else decoder.field["resolution"],
+             "class_counts": {int(c): int(n) for c, n in zip(*np.unique(labels, return_counts=True))}}
+    with open(os.path.join(args.dst, INDEX), "w") as f:
+        json.dump(index, f, indent=1)
+    print(f"\n{args.src} -> {args.dst} ({num_instances} instances of {shape} as {index['dtype']} in {len(shards)} shards)")
+
+
+class SynsetShards(torch.utils.data.Dataset):
+    # Random access to an exported synset. The shards are memory-mapped (copy-on-write, so the returned tensors share
+    # the mapped pages) and opened lazily, i.e. once per DataLoader worker.
+    # uint8 data is returned as float normalized with the stored mean/std, unless raw=True.
+    def __init__(self, root, raw=False):
+        self.root = root
+        self.raw = raw
+        with open(os.path.join(root, INDEX)) as f:
+            self.index = json.load(f)
+        self.labels = torch.from_numpy(np.load(os.path.join(root, "labels.npy")))
+        self.starts = np.array([s["start"] for s in self.index["shards"]])
+        self.shards = [None] * len(self.index["shards"])
+        if self.index["uint8"] and not raw:
+            bcast = channel_shape(len(self.index["mean"]), self.index["channel_dim"] - 1, len(self.index["shape"]))
+            self.mean = torch.tensor(self.index["mean"]).view(bcast)
+            self.std = torch.tensor(self.index["std"]).view(bcast)
+
+    def __len__(self):
+        return self.index["num_instances"]
+
+    def shard(self, k):
+        if self.shards[k] is None:
+            self.shards[k] = np.load(os.path.join(self.root, self.index["shards"][k]["file"]), mmap_mode="c")
+        return self.shards[k]
+
+    def indices_of(self, label):
+        return (self.labels == label).nonzero(as_tuple=False).view(-1)
+
+    def __getitem__(self, idx):
+        k = int(np.searchsorted(self.starts, idx, side="right")) - 1
+        x = torch.from_numpy(self.shard(k)[idx - self.starts[k]])
+        if self.index["uint8"] and not self.raw:
+            x = (x.float() / 255 - self.mean) / self.std
+        return x, self.labels[idx]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synset Export')
+    parser.add_argument('src', type=str, help='synset checkpoint (legacy or packed)')
+    parser.add_argument('dst', type=str, help='output directory')
+    parser.add_argument('--resolution', type=int, nargs='+', default=None, help='decoded grid, e.g. 64 64 (default: training resolution)')
+    parser.add_argument('--batch_size', type=int, default=256, help='instances decoded at once')
+    parser.add_argument('--decode_mem', type=float, default=1024, help='decode memory ceiling in MB (0 means unlimited)')
+    parser.add_argument('--shard_size', type=int, default=10000, help='instances per shard')
+    parser.add_argument('--uint8', action='store_true', help='quantize to uint8 after de-normalization with mean/std')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='dtype without --uint8')
+    parser.add_argument('--mean', type=float, nargs='+', default=None, help='mean of the data (default: stored in the checkpoint)')
+    parser.add_argument('--std', type=float, nargs='+', default=None, help='std of the data (default: stored in the checkpoint)')
+    parser.add_argument('--no_zca', action='store_true', help='keep the ZCA whitened data')
+    parser.add_argument('--field', type=str, default='', help='JSON field configuration for checkpoints without it (see SynsetDecoder)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    export(args)
@@ -0,0 +1,556 @@
+import numpy as np
+import torch
+import time
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+from math import sqrt
+from functools import lru_cache
+
+# Stacked (batched) neural fields.
+# Every instance owns one slice of each stacked parameter, e.g. a weight of shape (num_instances, dim_out, dim_in),
+# so any subset of instances is decoded with a single batched op per layer.
+# FieldBank implements chunked/checkpointed decoding, warm-up fitting and the conversion to per-instance state_dicts;
+# a field type defines its parameters (stacked_params, state_dict_keys) and decode_params.
+
+# Registry of field types (backends), selected with --field.
+# A backend is a FieldBank registered under a name with register_field, and provides
+#   from_args(args, num_instances, resolution)   construction from the command line arguments
+#   budget_per_instance()                         parameters of a single instance
+#   decode_params(coord, params, dtype)           batched decode
+#   config_keys / config() / from_config()        serialization of the hyperparameters (stored in the synset header)
+FIELDS = {}
+
+
+def register_field(name):
+    def register(cls):
+        cls.field_name = name
+        FIELDS[name] = cls
+        return cls
+    return register
+
+
+def build_field(num_instances, config):
+    # FieldBank from a config() (checkpoints without "field" in the config are SIREN)
+    return FIELDS[config.get("field", "siren")].from_config(num_instances, config)
+
+class FieldBank(nn.Module):
+    field_name = None
+    config_keys = []
+
+    @classmethod
+    def from_args(cls, args, num_instances, resolution):
+        raise NotImplementedError
+
+    @classmethod
+    def from_config(cls, num_instances, config):
+        return cls(num_instances=num_instances, **{k: config[k] for k in cls.config_keys})
+
+    def config(self):
+        return dict({"field": self.field_name}, **{k: getattr(self, k) for k in self.config_keys})
+
+    def budget_per_instance(self):
+        return sum(p[0].nelement() for p in self.stacked_params())
+
+    def forward(self, coord, indices=None, max_bytes=0, use_checkpoint=False, dtype=None):
+        # coord: (P, dim_in) shared by all instances -> (len(indices), P, dim_out)
+        num_instances = self.num_instances if indices is None else len(indices)
+        chunk_size = self.chunk_size(num_instances, len(coord), max_bytes)
+
+        # Decode chunks of coordinates so that the activations of at most one chunk are alive.
+        # With checkpointing only coordinates and indices are saved, and activations are recomputed in backward.
+        use_checkpoint = torch.is_grad_enabled() and (use_checkpoint or chunk_size < len(coord))
+        outputs = []
+        for coord_chunk in torch.split(coord, chunk_size):
+            if use_checkpoint:
+                outputs.append(checkpoint(self.decode_indices, coord_chunk, indices, dtype, use_reentrant=False))
+            else:
+                outputs.append(self.decode_indices(coord_chunk, indices, dtype))
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=1)
+
+    def decode_indices(self, coord, indices=None, dtype=None):
+        params = list(self.stacked_params())
+        if indices is not None:
+            params = [p[indices] for p in params]
+        return self.decode_fn()(coord, params, dtype)
+
+    def chunk_size(self, num_instances, num_points, max_bytes=0):
+        if max_bytes <= 0:
+            return num_points
+        return max(1, min(num_points, int(max_bytes // (num_instances * self.activation_bytes_per_point()))))
+
+    def fit_chunk_size(self, requested, num_points, max_bytes=0):
+        # instances fitted at once: at most `requested`, and with max_bytes only as many as have their activations over
+        # all num_points within max_bytes (at least one, whose coordinates are then chunked by fit)
+        if max_bytes <= 0:
+            return requested
+        return max(1, min(requested, int(max_bytes // (num_points * self.activation_bytes_per_point()))))
+
+    def decode_params(self, coord, params, dtype=None):
+        # coord: (P, dim_in), params: stacked parameters in the order of stacked_params() -> (len(params[0]), P, dim_out)
+        raise NotImplementedError
+
+    def decode_fn(self):
+        return self.decode_params if self.compiled_decode is None else self.compiled_decode
+
+    def compile_decode(self, coord):
+        # torch.compile the decode so that the elementwise ops following each matmul/gather are fused.
+        # The compiled decode is checked against eager on `coord` (forward and backward), and any failure keeps eager.
+        self.compiled_decode = None
+        if not hasattr(torch, "compile"):
+            return False, "torch.compile is not available"
+        try:
+            compiled_decode = torch.compile(self.decode_params, dynamic=True)
+            indices = torch.arange(min(2, self.num_instances), device=coord.device)
+            params = [p[indices] for p in self.stacked_params()]
+            expected = self.decode_params(coord, params)
+            output = compiled_decode(coord, params)
+            grads = torch.autograd.grad(output.sum(), list(self.parameters()))
+            if not torch.allclose(output, expected, atol=1e-4, rtol=1e-4):
+                return False, f"compiled decode mismatch (max abs error {(output - expected).abs().max().item():.3e})"
+            del grads
+        except Exception as e:
+            return False, f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+        self.compiled_decode = compiled_decode
+        return True, "ok"
+
+    def fit(self, indices, coord, values, epochs, lr, target_loss=0., betas=(0.9, 0.999), eps=1e-8, max_bytes=0):
+        # Warm-up fitting of instances `indices` to values (len(indices), P, dim_out), all instances at once.
+        # Adam is applied per element exactly as torch.optim.Adam, and the loss is the sum of per-instance MSE,
+        # so each instance follows the same trajectory as if it were fitted alone.
+        # Instances whose MSE reaches target_loss stop updating and are dropped from the working set.
+        # With max_bytes, the gradient is accumulated over coordinate chunks whose activations fit max_bytes (as in forward).
+        beta1, beta2 = betas
+        params = [p[indices].detach().clone().requires_grad_(True) for p in self.stacked_params()]
+        exp_avgs = [torch.zeros_like(p) for p in params]
+        exp_avg_sqs = [torch.zeros_like(p) for p in params]
+        alive = torch.arange(len(indices), device=indices.device)
+        recon_loss = torch.zeros(len(indices), dtype=values.dtype, device=values.device)
+
+        for step in range(1, epochs + 1):
+            chunk_size = self.chunk_size(len(alive), len(coord), max_bytes)
+            if chunk_size >= len(coord):
+                predicted = self.decode_fn()(coord, params)
+                loss = ((predicted - values) ** 2).mean(dim=(1, 2))
+                grads = torch.autograd.grad(loss.sum(), params)
+            else:
+                loss, grads = 0., [torch.zeros_like(p) for p in params]
+                for start in range(0, len(coord), chunk_size):
+                    predicted = self.decode_fn()(coord[start:start + chunk_size], params)
+                    chunk_loss = ((predicted - values[:, start:start + chunk_size]) ** 2).sum(dim=(1, 2)) / values[0].numel()
+                    for g, chunk_grad in zip(grads, torch.autograd.grad(chunk_loss.sum(), params)):
+                        g += chunk_grad
+                    loss = loss + chunk_loss.detach()
+            loss = loss.detach()
+            recon_loss[alive] = loss
+
+            with torch.no_grad():
+                if target_loss > 0:
+                    done = loss <= target_loss
+                    if done.any():
+                        self._write_rows(indices[alive[done]], [p[done] for p in params])
+                        keep = ~done
+                        params = [p[keep].detach().requires_grad_(True) for p in params]
+                        grads = [g[keep] for g in grads]
+                        exp_avgs = [m[keep] for m in exp_avgs]
+                        exp_avg_sqs = [v[keep] for v in exp_avg_sqs]
+                        values = values[keep]
+                        alive = alive[keep]
+                        if len(alive) == 0:
+                            break
+
+                bias_correction1 = 1 - beta1 ** step
+                bias_correction2_sqrt = sqrt(1 - beta2 ** step)
+                for p, g, m, v in zip(params, grads, exp_avgs, exp_avg_sqs):
+                    m.lerp_(g, 1 - beta1)
+                    v.mul_(beta2).addcmul_(g, g, value=1 - beta2)
+                    denom = (v.sqrt() / bias_correction2_sqrt).add_(eps)
+                    p.addcdiv_(m, denom, value=-lr / bias_correction1)
+
+        if len(alive) > 0:
+            self._write_rows(indices[alive], params)
+        return recon_loss
+
+    def _write_rows(self, rows, params):
+        with torch.no_grad():
+            for p, src in zip(self.stacked_params(), params):
+                p[rows] = src.to(p.dtype)
+
+    ### Conversion from/to the state_dict of a single field (format of saved synsets) ###
+    def instance_state_dict(self, idx):
+        return {k: p[idx].detach().to("cpu").clone() for k, p in zip(self.state_dict_keys(), self.stacked_params())}
+
+    def load_instance_state_dict(self, idx, state_dict):
+        with torch.no_grad():
+            for k, p in zip(self.state_dict_keys(), self.stacked_params()):
+                p[idx].copy_(state_dict[k])
+
+    def state_dicts(self):
+        keys = self.state_dict_keys()
+        params = [p.detach().to("cpu") for p in self.stacked_params()]
+        return [{k: p[idx].clone() for k, p in zip(keys, params)} for idx in range(self.num_instances)]
+
+    def load_state_dicts(self, state_dicts):
+        assert len(state_dicts) == self.num_instances
+        self.load_stacked_params([torch.stack([sd[k] for sd in state_dicts]) for k in self.state_dict_keys()])
+
+    def load_stacked_params(self, params):
+        with torch.no_grad():
+            for p, src in zip(self.stacked_params(), params):
+                p.copy_(src)
+
+
+# Stacked SIREN (Sitzmann et al., 2020), with the state_dict keys of the per-instance Siren of the original DDiF code
+
+@register_field("siren")
+class SirenBank(FieldBank):
+    config_keys = ["dim_in", "dim_hidden", "dim_out", "num_layers", "w0", "w0_initial"]
+
+    def __init__(self, num_instances, dim_in, dim_hidden, dim_out, num_layers, w0=30., w0_initial=30., c=6.):
+        super().__init__()
+        self.num_instances = num_instances
+        self.dim_in = dim_in
+        self.dim_hidden = dim_hidden
+        self.dim_out = dim_out
+        self.num_layers = num_layers
+        self.w0 = w0
+        self.w0_initial = w0_initial
+
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        self.w0s = []
+        for ind in range(num_layers + 1):
+            is_first = ind == 0
+            is_last = ind == num_layers
+            layer_w0 = w0_initial if is_first else w0
+            layer_dim_in = dim_in if is_first else dim_hidden
+            layer_dim_out = dim_out if is_last else dim_hidden
+
+            w_std = (1 / layer_dim_in) if is_first else (sqrt(c / layer_dim_in) / layer_w0)
+            self.weights.append(nn.Parameter(torch.empty(num_instances, layer_dim_out, layer_dim_in).uniform_(-w_std, w_std)))
+            self.biases.append(nn.Parameter(torch.empty(num_instances, layer_dim_out).uniform_(-w_std, w_std)))
+            self.w0s.append(None if is_last else layer_w0) # last layer has identity activation
+
+        self.compiled_decode = None
+
+    @classmethod
+    def from_args(cls, args, num_instances, resolution):
+        return cls(num_instances=num_instances, dim_in=args.dim_in, dim_hidden=args.layer_size, dim_out=args.dim_out, num_layers=args.num_layers, w0_initial=args.w0_initial, w0=args.w0)
+
+    @staticmethod
+    def budget(dim_in, dim_hidden, dim_out, num_layers):
+        return (dim_in + 1) * dim_hidden + (num_layers - 1) * (dim_hidden + 1) * dim_hidden + (dim_hidden + 1) * dim_out
+
+    def activation_bytes_per_point(self, element_size=4):
+        # pre- and post-activation of every hidden layer plus the output, for a single instance
+        return (2 * self.dim_hidden * self.num_layers + self.dim_out) * element_size
+
+    def decode(self, coord, weights, biases, dtype=None):
+        # dtype (e.g. torch.bfloat16) runs the matmuls of the hidden and last layers in reduced precision on casted copies
+        # of the fp32 parameters. The coordinates, the first layer and every sine stay in fp32: sin(w0 * x) with
+        # w0_initial = 30 multiplies the rounding error of x by 30, which bf16 (8-bit mantissa) makes visible.
+        x = coord
+        for ind, (w, b, w0) in enumerate(zip(weights, biases, self.w0s)):
+            if dtype is not None and ind > 0:
+                x, w, b = x.to(dtype), w.to(dtype), b.to(dtype)
+            if x.dim() == 2:
+                x = torch.matmul(x, w.transpose(1, 2)) + b.unsqueeze(1)
+            else:
+                x = torch.baddbmm(b.unsqueeze(1), x, w.transpose(1, 2))
+            if w0 is not None:
+                x = torch.sin(w0 * x.to(coord.dtype))
+        return x.to(coord.dtype)
+
+    def decode_params(self, coord, params, dtype=None):
+        return self.decode(coord, params[0::2], params[1::2], dtype)
+
+    def state_dict_keys(self):
+        keys = []
+        for ind in range(self.num_layers + 1):
+            prefix = "last_layer" if ind == self.num_layers else f"net.{ind}"
+            keys += [f"{prefix}.linear.weight", f"{prefix}.linear.bias"]
+        return keys
+
+    def stacked_params(self):
+        params = []
+        for w, b in zip(self.weights, self.biases):
+            params += [w, b]
+        return params
+
+
+# Stacked multi-resolution hash-grid encoding followed by a one-hidden-layer ReLU MLP (as in Instant-NGP).
+# Level l is a grid of resolutions[l] cells per axis whose vertices hold `features` values, stored densely when the
+# grid has at most table_size vertices and in a spatially hashed table of table_size entries otherwise.
+# The vertex indices and interpolation weights only depend on the coordinates, which are shared by all instances,
+# so a decode is one gather per level plus two batched matmuls, independent of the number of hidden layers of a SIREN.
+HASH_PRIMES = [1, 2654435761, 805459861]
+
+@register_field("hashgrid")
+class HashGridBank(FieldBank):
+    config_keys = ["dim_in", "dim_hidden", "dim_out", "levels", "features", "table_size", "base_res", "max_res"]
+
+    def __init__(self, num_instances, dim_in, dim_hidden, dim_out, levels=2, features=2, table_size=2 ** 10, base_res=4, max_res=32):
+        super().__init__()
+        self.num_instances = num_instances
+        self.dim_in = dim_in
+        self.dim_hidden = dim_hidden
+        self.dim_out = dim_out
+        self.levels = levels
+        self.features = features
+        self.table_size = table_size
+        self.base_res = base_res
+        self.max_res = max_res
+        self.resolutions = self.level_resolutions(levels, base_res, max_res)
+
+        self.tables = nn.ParameterList()
+        for res in self.resolutions:
+            self.tables.append(nn.Parameter(torch.empty(num_instances, min(table_size, (res + 1) ** dim_in), features).uniform_(-1e-4, 1e-4)))
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for layer_dim_in, layer_dim_out in [(levels * features, dim_hidden), (dim_hidden, dim_out)]:
+            w_std = 1 / sqrt(layer_dim_in)
+            self.weights.append(nn.Parameter(torch.empty(num_instances, layer_dim_out, layer_dim_in).uniform_(-w_std, w_std)))
+            self.biases.append(nn.Parameter(torch.empty(num_instances, layer_dim_out).uniform_(-w_std, w_std)))
+
+        self.compiled_decode = None
+        self.cell_corners = {} # device -> corners of a cell, see corners()
+
+    @classmethod
+    def from_args(cls, args, num_instances, resolution):
+        table_size = args.hash_table_size
+        if table_size <= 0:
+            # same budget per instance as the SIREN of layer_size and num_layers
+            table_size = cls.table_size_for_budget(SirenBank.budget(args.dim_in, args.layer_size, args.dim_out, args.num_layers), args.dim_in, args.layer_size, args.dim_out,
+                                                   args.hash_levels, args.hash_features, 4, max(resolution))
+        return cls(num_instances=num_instances, dim_in=args.dim_in, dim_hidden=args.layer_size, dim_out=args.dim_out, levels=args.hash_levels, features=args.hash_features,
+                   table_size=table_size, base_res=4, max_res=max(resolution))
+
+    @staticmethod
+    def level_resolutions(levels, base_res, max_res):
+        # geometric progression from base_res to max_res - 1 cells, so that the vertices of the finest level are the pixels
+        finest = max(max_res - 1, base_res)
+        growth = (finest / base_res) ** (1 / (levels - 1)) if levels > 1 else 1.
+        return [int(base_res * growth ** l + 1e-6) for l in range(levels)]
+
+    @staticmethod
+    def budget(dim_in, dim_hidden, dim_out, levels, features, table_size, base_res, max_res):
+        tables = sum(min(table_size, (res + 1) ** dim_in) * features for res in HashGridBank.level_resolutions(levels, base_res, max_res))
+        return tables + (levels * features + 1) * dim_hidden + (dim_hidden + 1) * dim_out
+
+    @staticmethod
+    def table_size_for_budget(target, dim_in, dim_hidden, dim_out, levels, features, base_res, max_res):
+        # largest table size whose budget per instance does not exceed target (e.g. the budget of a SIREN)
+        low, high = 0, target
+        while low < high:
+            mid = (low + high + 1) // 2
+            if HashGridBank.budget(dim_in, dim_hidden, dim_out, levels, features, mid, base_res, max_res) <= target:
+                low = mid
+            else:
+                high = mid - 1
+        assert low > 0, f"Budget {target} is too small for a hash grid with {levels} levels, {features} features and a MLP of width {dim_hidden}"
+        return low
+
+    def activation_bytes_per_point(self, element_size=4):
+        # gathered vertex features, interpolated features, pre- and post-activation of the hidden layer and the output
+        return (self.levels * self.features * (2 ** self.dim_in + 1) + 2 * self.dim_hidden + self.dim_out) * element_size
+
+    def corners(self, device):
+        # (2 ** dim_in, dim_in) offsets of the vertices of a cell, cached per device (not a buffer, so that the parameter
+        # count of the bank is its budget)
+        if device not in self.cell_corners:
+            self.cell_corners[device] = torch.tensor([[(c >> i) & 1 for i in range(self.dim_in)] for c in range(2 ** self.dim_in)], device=device)
+        return self.cell_corners[device]
+
+    def vertices(self, coord, level):
+        # vertex indices (P, 2 ** dim_in) and interpolation weights (P, 2 ** dim_in) of level for coord in [-1, 1]
+        res = self.resolutions[level]
+        pos = ((coord + 1) / 2).clamp(0, 1) * res
+        pos0 = pos.floor().clamp(max=res - 1)
+        frac = pos - pos0
+        corners = self.corners(coord.device)
+        vertex = pos0.long().unsqueeze(1) + corners.unsqueeze(0)
+        weight = torch.where(corners.unsqueeze(0).bool(), frac.unsqueeze(1), 1 - frac.unsqueeze(1)).prod(dim=-1)
+        if (res + 1) ** self.dim_in <= self.table_size:
+            index = sum(vertex[..., i] * (res + 1) ** i for i in range(self.dim_in))
+        else:
+            index = vertex[..., 0] * HASH_PRIMES[0]
+            for i in range(1, self.dim_in):
+                index = torch.bitwise_xor(index, vertex[..., i] * HASH_PRIMES[i])
+            index = index % self.table_size
+        return index, weight
+
+    def decode_params(self, coord, params, dtype=None):
+        tables, (w1, b1, w2, b2) = params[:self.levels], params[self.levels:]
+        x = []
+        for level, table in enumerate(tables):
+            index, weight = self.vertices(coord, level)
+            feature = table[:, index.view(-1)].view(len(table), len(coord), -1, self.features)
+            x.append(torch.einsum("npcf,pc->npf", feature, weight))
+        x = torch.cat(x, dim=-1)
+        if dtype is not None:
+            x, w1, b1, w2, b2 = x.to(dtype), w1.to(dtype), b1.to(dtype), w2.to(dtype), b2.to(dtype)
+        x = torch.relu(torch.baddbmm(b1.unsqueeze(1), x, w1.transpose(1, 2)))
+        x = torch.baddbmm(b2.unsqueeze(1), x, w2.transpose(1, 2))
+        return x.to(coord.dtype)
+
+    def state_dict_keys(self):
+        return [f"table.{l}" for l in range(self.levels)] + ["net.0.linear.weight", "net.0.linear.bias", "last_layer.linear.weight", "last_layer.linear.bias"]
+
+    def stacked_params(self):
+        return list(self.tables) + [self.weights[0], self.biases[0], self.weights[1], self.biases[1]]
+
+
+# Stacked Fourier feature MLP (as in Tancik et al., 2020): [sin(2 pi B x), cos(2 pi B x)] followed by a ReLU MLP with
+# num_layers hidden layers. The frequencies B (features x dim_in) are learned per instance and count towards the budget.
+@register_field("fourier_mlp")
+class FourierMLPBank(FieldBank):
+    config_keys = ["dim_in", "dim_hidden", "dim_out", "num_layers", "features", "scale"]
+
+    def __init__(self, num_instances, dim_in, dim_hidden, dim_out, num_layers, features=16, scale=10.):
+        super().__init__()
+        self.num_instances = num_instances
+        self.dim_in = dim_in
+        self.dim_hidden = dim_hidden
+        self.dim_out = dim_out
+        self.num_layers = num_layers
+        self.features = features
+        self.scale = scale
+
+        self.frequencies = nn.Parameter(torch.randn(num_instances, features, dim_in) * scale / 2) # coordinates span [-1, 1]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for ind in range(num_layers + 1):
+            layer_dim_in = 2 * features if ind == 0 else dim_hidden
+            layer_dim_out = dim_out if ind == num_layers else dim_hidden
+            w_std = 1 / sqrt(layer_dim_in)
+            self.weights.append(nn.Parameter(torch.empty(num_instances, layer_dim_out, layer_dim_in).uniform_(-w_std, w_std)))
+            self.biases.append(nn.Parameter(torch.empty(num_instances, layer_dim_out).uniform_(-w_std, w_std)))
+        self.compiled_decode = None
+
+    @classmethod
+    def from_args(cls, args, num_instances, resolution):
+        return cls(num_instances=num_instances, dim_in=args.dim_in, dim_hidden=args.layer_size, dim_out=args.dim_out, num_layers=args.num_layers,
+                   features=args.fourier_features, scale=args.fourier_scale)
+
+    def activation_bytes_per_point(self, element_size=4):
+        # projection, sin/cos features, pre- and post-activation of every hidden layer plus the output
+        return (3 * self.features + 2 * self.dim_hidden * self.num_layers + self.dim_out) * element_size
+
+    def decode_params(self, coord, params, dtype=None):
+        frequencies, weights, biases = params[0], params[1::2], params[2::2]
+        x = 2 * np.pi * torch.matmul(coord, frequencies.transpose(1, 2))
+        x = torch.cat([torch.sin(x), torch.cos(x)], dim=-1)
+        for ind, (w, b) in enumerate(zip(weights, biases)):
+            if dtype is not None:
+                x, w, b = x.to(dtype), w.to(dtype), b.to(dtype)
+            x = torch.baddbmm(b.unsqueeze(1), x, w.transpose(1, 2))
+            if ind < self.num_layers:
+                x = torch.relu(x)
+        return x.to(coord.dtype)
+
+    def state_dict_keys(self):
+        keys = ["encoding.frequencies"]
+        for ind in range(self.num_layers + 1):
+            prefix = "last_layer" if ind == self.num_layers else f"net.{ind}"
+            keys += [f"{prefix}.linear.weight", f"{prefix}.linear.bias"]
+        return keys
+
+    def stacked_params(self):
+        params = [self.frequencies]
+        for w, b in zip(self.weights, self.biases):
+            params += [w, b]
+        return params
+
+
+class SparseFieldAdam():
+    # Adam over the stacked parameters of a FieldBank that behaves as a separate torch.optim.Adam per instance, i.e. as
+    # the per-instance Sirens the bank replaces: only the instances (rows) decoded with gradients since the last step are
+    # updated, each with its own step count for the bias correction. The other rows and their moments are left as they
+    # are, as an instance without gradients (grad None) is skipped by torch.optim.Adam.
+    def __init__(self, bank, lr, betas=(0.9, 0.999), eps=1e-8):
+        self.params = bank.stacked_params()
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.exp_avgs = [torch.zeros_like(p, memory_format=torch.preserve_format) for p in self.params]
+        self.exp_avg_sqs = [torch.zeros_like(p, memory_format=torch.preserve_format) for p in self.params]
+        self.steps = torch.zeros(bank.num_instances, dtype=torch.long, device=self.params[0].device) # Adam steps of each row
+        self.touched = torch.zeros(bank.num_instances, dtype=torch.bool, device=self.params[0].device)
+
+    def zero_grad(self):
+        for p in self.params:
+            p.grad = None
+
+    def touch(self, indices=None):
+        # rows decoded with gradients, stepped by the next step()
+        if indices is None:
+            self.touched[:] = True
+        else:
+            self.touched[indices] = True
+
+    @torch.no_grad()
+    def step(self):
+        rows = self.touched.nonzero(as_tuple=False).view(-1)
+        self.touched[:] = False
+        if len(rows) == 0 or all(p.grad is None for p in self.params):
+            return
+        self.steps[rows] += 1
+        grads = [None if p.grad is None else p.grad[rows] for p in self.params]
+        self.update(rows, self.steps[rows], grads)
+
+    @torch.no_grad()
+    def update(self, rows, steps, grads):
+        # One Adam step of rows at per-row step counts, in the same operation order as torch.optim.Adam
+        # (a None entry of grads means a zero gradient)
+        beta1, beta2 = self.betas
+        steps = steps.double()
+        step_sizes = self.lr / (1 - beta1 ** steps)
+        bias_corrections2_sqrt = torch.sqrt(1 - beta2 ** steps)
+        for p, m, v, g in zip(self.params, self.exp_avgs, self.exp_avg_sqs, grads):
+            shape = (-1,) + (1,) * (p.dim() - 1)
+            step_size, bias_correction2_sqrt = step_sizes.to(p.dtype), bias_corrections2_sqrt.to(p.dtype)
+            m_rows, v_rows = m[rows], v[rows]
+            if g is None:
+                g = torch.zeros_like(m_rows)
+            m_rows.lerp_(g, 1 - beta1)
+            v_rows.mul_(beta2).addcmul_(g, g, value=1 - beta2)
+            denom = (v_rows.sqrt() / bias_correction2_sqrt.view(shape)).add_(self.eps)
+            p[rows] = p[rows] - step_size.view(shape) * (m_rows / denom)
+            m[rows], v[rows] = m_rows, v_rows
+
+
+def to_index_tensor(indices, device):
+    if torch.is_tensor(indices):
+        return indices.long().to(device)
+    return torch.as_tensor(np.asarray(indices), dtype=torch.long, device=device)
+
+
+@lru_cache(maxsize=8)
+def _coordinate_grid(resolution, native, norm, device):
+    axes = []
+    for r, n, s in zip(resolution, native, norm):
+        step = (n - 1) / (r - 1) if r > 1 else 0.
+        axes.append((torch.arange(r, dtype=torch.float32) * step / s - 0.5) * 2)
+    coordinates = torch.stack(torch.meshgrid(*axes, indexing="ij"), dim=-1).reshape(-1, len(resolution))
+    return coordinates.to(device)
+
+
+def coordinate_grid(resolution, native, norm, device):
+    # Coordinates of a `resolution` grid covering the native grid (coordinates in [-1, 1], as in the original DDiF code),
+    # where axis k of the native grid is normalized by norm[k]. Recently used grids are kept in a small LRU cache.
+    return _coordinate_grid(tuple(resolution), tuple(native), tuple(norm), torch.device(device))
+
+def measure_decode(bank, coord, indices, **kwargs):
+    # Bytes saved for backward and wall time of one forward+backward decode (parameter .grad is left untouched)
+    saved_bytes = [0]
+
+    def pack(x):
+        saved_bytes[0] += x.numel() * x.element_size()
+        return x
+
+    start = time.time()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        out = bank(coord, indices, **kwargs)
+    torch.autograd.grad(out.sum(), list(bank.parameters()))
+    if coord.is_cuda:
+        torch.cuda.synchronize()
+    return saved_bytes[0], time.time() - start
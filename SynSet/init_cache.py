@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import argparse
+import contextlib
+
+# Content-addressed cache of warm-up initialized synsets, shared by all entry points and concurrent jobs on a box.
+#   {root}/{key}.pt    packed synset (see synset_io.py)
+#   {root}/{key}.json  sha256 and size of the .pt, creation time and the fields the key was computed from
+#   {root}/{key}.lock  flock held while an entry is looked up or fitted, so concurrent jobs fit a key only once
+# The key is the sha256 of the key fields (dataset, seed, selected real data, field hyperparameters and the version of
+# the fitting code). An entry becomes visible only once its .json is in place, and both files are written to a
+# temporary file and moved with os.replace, so a crashed or concurrent writer never leaves a partial entry behind.
+
+CACHE_FORMAT = 1
+CODE_FILES = ["field_bank.py", "synset_io.py", "DDiF.py"]
+
+
+def code_version():
+    digest = hashlib.sha256(str(CACHE_FORMAT).encode())
+    for name in CODE_FILES:
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def tensor_digest(x):
+    x = x.detach().to("cpu").contiguous()
+    return hashlib.sha256(str((x.dtype, tuple(x.shape))).encode() + x.numpy().tobytes()).hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class InitCache():
+    def __init__(self, root, max_bytes=0, max_age=0):
+        # max_bytes: total size of the cache (0 means unlimited), max_age: seconds since last use (0 means unlimited)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, fields):
+        fields = dict(fields, code_version=code_version())
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest(), fields
+
+    def path(self, key, ext="pt"):
+        return os.path.join(self.root, f"{key}.{ext}")
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        with open(self.path(key, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self, key):
+        # Path of a verified entry, or None if it is missing or corrupted (a corrupted entry is removed)
+        path, meta_path = self.path(key), self.path(key, "json")
+        if not (os.path.isfile(path) and os.path.isfile(meta_path)):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if os.path.getsize(path) != meta["size"] or file_digest(path) != meta["sha256"]:
+            self.remove(key)
+            return None
+        os.utime(path) # last use, for the eviction by age
+        return path
+
+    def store(self, key, save_fn, fields):
+        # save_fn(path) writes the entry, e.g. a partial of synset_io.save_packed
+        path, meta_path = self.path(key), self.path(key, "json")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        save_fn(tmp)
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+        meta = {"sha256": file_digest(tmp), "size": os.path.getsize(tmp), "created": time.time(), "fields": fields}
+        os.replace(tmp, path)
+        with open(f"{meta_path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(meta, f, indent=1, default=str)
+        os.replace(f"{meta_path}.{os.getpid()}.tmp", meta_path)
+        self.evict(keep=key)
+        return path
+
+    def remove(self, key):
+        for ext in ["json", "pt"]:
+            if os.path.isfile(self.path(key, ext)):
+                os.remove(self.path(key, ext))
+
+    def entries(self):
+        # [(key, size in bytes, last use, meta)], most recently used first
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            if not os.path.isfile(self.path(key)):
+                continue
+            with open(self.path(key, "json")) as f:
+                meta = json.load(f)
+            entries.append((key, os.path.getsize(self.path(key)), os.path.getmtime(self.path(key)), meta))
+        return sorted(entries, key=lambda e: -e[2])
+
+    def evict(self, keep=None, max_bytes=None, max_age=None):
+        # Remove entries unused for more than max_age, then the least recently used ones until the cache fits max_bytes
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_age = self.max_age if max_age is None else max_age
+        removed, total, now = [], 0, time.time()
+        for key, size, last_use, _ in self.entries():
+            if key != keep and ((max_age > 0 and now - last_use > max_age) or (max_bytes > 0 and total + size > max_bytes)) and self.try_remove(key):
+                removed.append(key)
+            else:
+                total += size
+        return removed
+
+    def try_remove(self, key):
+        # Remove an entry unless another job holds its lock (i.e. is loading or fitting it)
+        with open(self.path(key, "lock"), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            self.remove(key)
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Initialized Synset Cache')
+    parser.add_argument('command', type=str, choices=['list', 'prune'])
+    parser.add_argument('--root', type=str, default='../initialized_synset', help='cache directory')
+    parser.add_argument('--max_gb', type=float, default=0, help='prune: total size of the cache in GB (0 means unlimited)')
+    parser.add_argument('--max_age', type=float, default=0, help='prune: days since last use (0 means unlimited)')
+    args = parser.parse_args()
+
+    cache = InitCache(args.root)
+    if args.command == 'list':
+        entries = cache.entries()
+        for key, size, last_use, meta in entries:
+            fields = meta["fields"]
+            print(f"{key[:16]}  {size / 2 ** 20:9.2f} MB  {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_use))}  "
+                  f"{fields.get('domain')} {fields.get('dataset')} ipc={fields.get('ipc')} seed={fields.get('seed')} field={fields.get('field')}")
+        print(f"{len(entries)} entries, {sum(e[1] for e in entries) / 2 ** 30:.3f} GB")
+    else:
+        removed = cache.evict(max_bytes=args.max_gb * 2 ** 30, max_age=args.max_age * 24 * 3600)
+        print(f"Removed {len(removed)} entries")
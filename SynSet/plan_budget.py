@@ -0,0 +1,106 @@
+import argparse
+import torch
+
+from field_bank import SirenBank, coordinate_grid
+from benchmark_decode import PIPELINES, timeit
+
+# Budget planner: enumerates the SIREN configurations (num_layers, layer_size) that fit the budget of a dataset,
+# resolution and ipc, measures the batched decode + backward of the fields decoded per iteration on this machine,
+# and prints the Pareto front of instances per class (dipc) against the cost per iteration.
+# The number of instances per class follows DDiF.__init__: int(ipc * channel * prod(grid) / budget per instance).
+# e.g. python SynSet/plan_budget.py --pipeline DC --dataset CIFAR10 --res 32 --ipc 10 --num_classes 10 --batch_syn 0
+#      python SynSet/plan_budget.py --pipeline DM --dataset ImageNet --res 128 --ipc 1 --num_classes 10 --max_ms 50 --emit
+
+
+def grid_of(args):
+    # native grid and coordinate normalization of the pipeline (see the ShapeSpec of each DDiF)
+    if args.pipeline == "Video":
+        return (args.frames, args.res, args.res), (args.frames - 1, args.res - 1, args.res - 1)
+    dim_in = 3 if args.pipeline == "3D_Voxel" else 2
+    return (args.res,) * dim_in, (args.res - 1,) * dim_in
+
+
+def candidates(args, grid, channel):
+    numel = channel * int(torch.tensor(grid).prod().item())
+    for num_layers in args.num_layers:
+        for layer_size in range(args.min_layer_size, args.max_layer_size + 1, args.layer_size_step):
+            budget = SirenBank.budget(len(grid), layer_size, channel, num_layers)
+            num_per_class = int(args.ipc * numel / budget)
+            if num_per_class >= 1:
+                yield num_layers, layer_size, budget, num_per_class
+
+
+def pareto_front(plans):
+    # plans sorted by cost; a plan is on the front if no cheaper plan has at least as many instances per class
+    front, best = [], 0
+    for plan in sorted(plans, key=lambda p: (p["ms"], -p["dipc"])):
+        if plan["dipc"] > best:
+            front.append(plan)
+            best = plan["dipc"]
+    return front
+
+
+def hyper_params_entry(args, plan, channel):
+    key = f"{args.dataset}_{args.res}"
+    values = {"DIM_IN": plan["dim_in"], "NUM_LAYERS": plan["num_layers"], "LAYER_SIZE": plan["layer_size"], "DIM_OUT": channel, "W0_INITIAL": args.w0_initial, "W0": args.w0}
+    lines = [f"# {key} ipc {args.ipc}: {plan['dipc']} instances per class, {plan['ms']:.2f} ms per iteration (--dipc 0)"]
+    lines += [f"{name}.setdefault(\"{key}\", {{}})[{args.ipc}] = {value}" for name, value in values.items()]
+    return "\n".join(lines)
+
+
+def main(args):
+    device = torch.device(args.device)
+    channel = args.channel if args.channel > 0 else PIPELINES[args.pipeline]
+    grid, norm = grid_of(args)
+    coord = coordinate_grid(grid, grid, norm, device)
+
+    plans = []
+    for num_layers, layer_size, budget, num_per_class in candidates(args, grid, channel):
+        decoded = args.num_classes * (min(args.batch_syn, num_per_class) if args.batch_syn > 0 else num_per_class)
+        bank = SirenBank(num_instances=decoded, dim_in=len(grid), dim_hidden=layer_size, dim_out=channel, num_layers=num_layers, w0_initial=args.w0_initial, w0=args.w0).to(device)
+        params = list(bank.parameters())
+
+        def forward_backward():
+            torch.autograd.grad(bank(coord, max_bytes=args.decode_mem * 2 ** 20).sum(), params)
+
+        ms = timeit(forward_backward, args.repeat, device) * 1000
+        plans.append({"dim_in": len(grid), "num_layers": num_layers, "layer_size": layer_size, "budget": budget, "dipc": num_per_class, "decoded": decoded, "ms": ms})
+
+    assert len(plans) > 0, f"No SIREN configuration fits ipc {args.ipc} of a {channel}x{'x'.join(map(str, grid))} grid"
+    front = pareto_front(plans)
+    print(f"{args.pipeline} {args.dataset}_{args.res} ipc {args.ipc}: {len(plans)} feasible configurations, {len(front)} on the Pareto front ({device})")
+    print(f"{'layers':>6} {'size':>5} {'budget':>7} {'dipc':>6} {'decoded':>8} {'ms/it':>9}  front")
+    for plan in sorted(plans, key=lambda p: (p["num_layers"], p["layer_size"])):
+        print(f"{plan['num_layers']:>6} {plan['layer_size']:>5} {plan['budget']:>7} {plan['dipc']:>6} {plan['decoded']:>8} {plan['ms']:>9.2f}  {'*' if plan in front else ''}")
+
+    if args.emit:
+        # most instances per class within max_ms (the last plan of the front is the one with the most instances)
+        affordable = [plan for plan in front if args.max_ms <= 0 or plan["ms"] <= args.max_ms]
+        plan = affordable[-1] if len(affordable) > 0 else front[0]
+        print(f"\n# hyper_params.py of {args.pipeline}\n{hyper_params_entry(args, plan, channel)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Budget Planner')
+    parser.add_argument('--pipeline', type=str, default='DC', choices=list(PIPELINES))
+    parser.add_argument('--dataset', type=str, default='CIFAR10')
+    parser.add_argument('--res', type=int, default=32)
+    parser.add_argument('--frames', type=int, default=16, help='Video: number of frames')
+    parser.add_argument('--channel', type=int, default=0, help='0 means the channels of the pipeline')
+    parser.add_argument('--ipc', type=int, default=10)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--batch_syn', type=int, default=0, help='instances decoded per class and iteration (0 means all)')
+    parser.add_argument('--num_layers', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('--min_layer_size', type=int, default=4)
+    parser.add_argument('--max_layer_size', type=int, default=64)
+    parser.add_argument('--layer_size_step', type=int, default=2)
+    parser.add_argument('--w0_initial', type=float, default=30.)
+    parser.add_argument('--w0', type=float, default=10.)
+    parser.add_argument('--decode_mem', type=float, default=0, help='decode memory ceiling in MB as in the pipelines (0 means unlimited)')
+    parser.add_argument('--max_ms', type=float, default=0, help='emit: cost ceiling per iteration in ms (0 means the plan with the most instances per class)')
+    parser.add_argument('--emit', action='store_true', help='print a hyper_params.py entry for the chosen plan')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,64 @@
+import time
+import torch
+import torch.nn.functional as F
+
+# Coarse-to-fine resolution schedule of distillation.
+# spec "it:res,it:res,..." e.g. "0:32,5000:64,10000:128": from iteration it on, the synthetic data is decoded and matched at res.
+# res is either a single size for the spatial axes (H = W = res; the frames of a video are kept) or a full shape such as
+# "8x56x56" (F x H x W of a video). An empty spec means the native resolution throughout.
+
+
+class ResSchedule():
+    def __init__(self, spec, native):
+        self.native = tuple(int(s) for s in native)
+        self.stages = [] # [(start iteration, resolution)]
+        for token in filter(None, (t.strip() for t in (spec or "").split(","))):
+            it, res = token.split(":")
+            res = [int(r) for r in res.split("x")]
+            if len(res) == 1:
+                res = list(self.native[:-2]) + res * 2
+            assert len(res) == len(self.native), f"Resolution schedule {token} does not match the data shape {self.native}"
+            self.stages.append((int(it), tuple(res)))
+        self.stages.sort()
+        if len(self.stages) == 0 or self.stages[0][0] > 0:
+            self.stages.insert(0, (0, self.native))
+        self.time = [0.] * len(self.stages)
+        self.start_time = None
+
+    def stage(self, it):
+        return max(i for i, (start, _) in enumerate(self.stages) if start <= it)
+
+    def resolution(self, it):
+        return self.stages[self.stage(it)][1]
+
+    def is_native(self, it):
+        return self.resolution(it) == self.native
+
+    def start(self):
+        self.start_time = time.time()
+
+    def stop(self, it):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.time[self.stage(it)] += time.time() - self.start_time
+
+    def summary(self):
+        lines = []
+        for i, (start, res) in enumerate(self.stages):
+            end = self.stages[i + 1][0] - 1 if i + 1 < len(self.stages) else "end"
+            lines.append(f"Stage {i} (it {start}-{end}, resolution {'x'.join(map(str, res))}): {self.time[i]:.1f}s")
+        return "\n".join(lines)
+
+
+def resize(x, resolution, channel_dim=1):
+    # x: (N, C, *shape) with channel_dim 1 (images) or (N, F, C, H, W) with channel_dim 2 (videos) -> same layout at resolution
+    resolution = tuple(resolution)
+    if channel_dim == 2:
+        if (x.shape[1],) + tuple(x.shape[3:]) == resolution:
+            return x
+        x = x.permute(0, 2, 1, 3, 4)
+        return F.interpolate(x, size=resolution, mode="trilinear", align_corners=True).permute(0, 2, 1, 3, 4).contiguous()
+    if tuple(x.shape[2:]) == resolution:
+        return x
+    mode = "bilinear" if len(resolution) == 2 else "trilinear"
+    return F.interpolate(x, size=resolution, mode=mode, align_corners=True, antialias=len(resolution) == 2 and x.shape[-1] > resolution[-1])
@@ -0,0 +1,147 @@
+import torch
+
+try:
+    from .field_bank import build_field, coordinate_grid
+except ImportError: # run as a script from SynSet/
+    from field_bank import build_field, coordinate_grid
+
+# Packed synset checkpoint.
+# The parameters of all instances are stored as one contiguous (num_instances, D) tensor, where the columns
+# [offsets[k], offsets[k] + numel(shapes[k])) of a row hold parameter keys[k] of that instance.
+# Loading with torch.load(path, mmap=True) maps the parameters from disk without any per-instance Python object.
+#   {"format": "packed", "params": (num_instances, D) tensor, "header": {"keys", "shapes", "offsets", "field"}, "label": labels, ...}
+# The legacy format is {"nf": [state_dict of each instance], "label": labels, "field": field config, ...}
+# (checkpoints written before the field config was stored have no "field").
+
+PACKED = "packed"
+
+
+def numel(shape):
+    n = 1
+    for s in shape:
+        n *= s
+    return n
+
+
+def pack(keys, params, field=None):
+    # params: stacked tensors (num_instances, *shape) in the order of keys
+    num_instances = len(params[0])
+    shapes, offsets, offset = [], [], 0
+    for p in params:
+        shapes.append(list(p.shape[1:]))
+        offsets.append(offset)
+        offset += numel(p.shape[1:])
+    flat = torch.cat([p.detach().to("cpu").reshape(num_instances, -1) for p in params], dim=1).contiguous()
+    header = {"keys": list(keys), "shapes": shapes, "offsets": offsets, "field": field}
+    return flat, header
+
+
+def unpack(flat, header, indices=None):
+    # stacked tensors (len(indices), *shape) in the order of header["keys"]; views of flat when indices is None
+    if indices is not None:
+        flat = flat[indices]
+    return [flat[:, offset:offset + numel(shape)].reshape(len(flat), *shape) for shape, offset in zip(header["shapes"], header["offsets"])]
+
+
+def save_packed(path, flat, header, labels, auxiliary=None):
+    save_data = {"format": PACKED, "params": flat, "header": header, "label": labels}
+    if type(auxiliary) == dict:
+        save_data.update(auxiliary)
+    torch.save(save_data, path)
+
+
+def is_packed(data):
+    return type(data) == dict and data.get("format") == PACKED
+
+
+def from_legacy(data, indices=None):
+    # indices: only these instances are stacked (with a memory-mapped checkpoint, only their tensors are read)
+    nf = data["nf"] if indices is None else [data["nf"][idx] for idx in indices]
+    keys = list(nf[0].keys())
+    flat, header = pack(keys, [torch.stack([sd[k] for sd in nf]) for k in keys], field=data.get("field"))
+    packed = {k: v for k, v in data.items() if k not in ["nf", "field"]}
+    packed.update({"format": PACKED, "params": flat, "header": header})
+    if indices is not None:
+        packed["label"] = data["label"][indices]
+    return packed
+
+
+def to_legacy(data):
+    keys = data["header"]["keys"]
+    params = unpack(data["params"], data["header"])
+    legacy = {k: v for k, v in data.items() if k not in ["format", "params", "header"]}
+    legacy["nf"] = [{k: p[idx].clone() for k, p in zip(keys, params)} for idx in range(len(data["params"]))]
+    legacy["field"] = data["header"]["field"]
+    return legacy
+
+
+def load_synset(path, mmap=True):
+    # Synset checkpoint of either format, returned in the packed format
+    data = torch.load(path, map_location="cpu", mmap=mmap)
+    if not is_packed(data):
+        data = from_legacy(data)
+    return data
+
+
+def select_indices(labels, indices=None, classes=None):
+    if classes is not None:
+        mask = torch.isin(labels, torch.as_tensor(list(classes), dtype=labels.dtype))
+        selected = mask.nonzero(as_tuple=False).view(-1)
+        if indices is not None:
+            selected = selected[torch.isin(selected, torch.as_tensor(list(indices), dtype=torch.long))]
+        return selected
+    if indices is not None:
+        return torch.as_tensor(list(indices), dtype=torch.long)
+    return torch.arange(len(labels))
+
+
+def load_subset(path, indices=None, classes=None):
+    # Only the rows of the requested instances are copied out of the memory-mapped checkpoint. For a legacy checkpoint the
+    # instances are selected before they are stacked, so only their state_dicts are read (the list itself is unpickled;
+    # convert it once with convert_synset.py to avoid even that).
+    data = torch.load(path, map_location="cpu", mmap=True)
+    selected = select_indices(data["label"], indices, classes)
+    if is_packed(data):
+        subset = {k: v for k, v in data.items() if k not in ["params", "label"]}
+        subset.update({"params": data["params"][selected].clone(), "label": data["label"][selected].clone()})
+    else:
+        subset = from_legacy(data, selected.tolist())
+        subset["label"] = subset["label"].clone()
+    subset["indices"] = selected
+    del data
+    return subset
+
+
+class SynsetDecoder():
+    # Decode-only view of a subset of a saved synset (no optimizer, no real data)
+    # field: configuration of the neural field, required for checkpoints without it (legacy checkpoints written before it was stored)
+    #        {field, config_keys of the field backend, resolution, coord_norm, channel_dim}, field defaults to siren
+    def __init__(self, path, indices=None, classes=None, device="cpu", field=None):
+        data = load_subset(path, indices, classes)
+        self.field = dict(data["header"]["field"] or {})
+        self.field.update(field or {})
+        self.indices = data["indices"]
+        self.label = data["label"].to(device)
+        self.auxiliary = {k: v for k, v in data.items() if k not in ["format", "params", "header", "label", "indices"]} # e.g. syn_lr, data
+        self.device = device
+
+        self.bank = build_field(len(self.indices), self.field)
+        self.bank.load_stacked_params(unpack(data["params"], data["header"]))
+        self.bank = self.bank.to(device)
+        del data
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get(self, indices=None, resolution=None, max_bytes=0, dtype=None):
+        # indices are positions within the subset; resolution defaults to the training resolution
+        native = tuple(self.field["resolution"])
+        resolution = native if resolution is None else tuple(int(r) for r in resolution)
+        coord = coordinate_grid(resolution, native, self.field["coord_norm"], self.device)
+        if indices is not None:
+            indices = torch.as_tensor(list(indices), dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            decoded = self.bank(coord, indices, max_bytes=max_bytes, dtype=dtype)
+        decoded = decoded.reshape(-1, *resolution, self.field["dim_out"]).movedim(-1, self.field.get("channel_dim", 1)).contiguous()
+        labels = self.label if indices is None else self.label[indices]
+        return decoded, labels
@@ -1,14 +1,141 @@
 import os
 import argparse
+import numpy as np
 import torch
 import torch.nn as nn
 from tqdm import tqdm
-from utils import get_dataset, get_network, get_daparam, TensorDataset, epoch, ParamDiffAug, set_seed, save_and_print
+from utils import get_dataset, get_network, get_daparam, TensorDataset, epoch, ParamDiffAug, set_seed, save_and_print, DiffAugment, augment, config
+from trajectory_store import append_trajectories
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", category=UserWarning)
 
+
+class RNGStream():
+    # Private RNG state (torch CPU and current CUDA device, and numpy, which the non-DSA augment draws from) of one
+    # teacher; code run inside `with stream:` draws from it
+    def __init__(self, seed):
+        self.cuda = torch.cuda.is_available()
+        saved = self.get()
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        self.state = self.get()
+        self.set(saved)
+
+    def get(self):
+        return (torch.get_rng_state(), torch.cuda.get_rng_state() if self.cuda else None, np.random.get_state())
+
+    def set(self, state):
+        torch.set_rng_state(state[0])
+        if self.cuda:
+            torch.cuda.set_rng_state(state[1])
+        np.random.set_state(state[2])
+
+    def __enter__(self):
+        self.saved = self.get()
+        self.set(self.state)
+
+    def __exit__(self, *exc):
+        self.state = self.get()
+        self.set(self.saved)
+
+
+def ensemble_epoch(mode, dataloader, net, params, optimizer, criterion, streams, args, aug):
+    # epoch() of utils.py for K teachers stacked along dim 0 of params: every batch is read once, augmented with the
+    # RNG stream of each teacher and fed to all teachers in one vmapped forward/backward pass
+    # -> per-teacher loss and accuracy
+    K = len(streams)
+    loss_avg, acc_avg, num_exp = torch.zeros(K), torch.zeros(K), 0
+    forward = torch.func.vmap(lambda p, x: torch.func.functional_call(net, p, (x,)), in_dims=(0, 0 if aug else None))
+
+    if args.dataset == "ImageNet":
+        class_map = {x: i for i, x in enumerate(config.img_net_classes)}
+
+    if mode == 'train':
+        net.train()
+    else:
+        net.eval()
+
+    for i_batch, datum in enumerate(dataloader):
+        img = datum[0].float().to(args.device)
+        lab = datum[1].long().to(args.device)
+
+        if aug:
+            augmented = []
+            for stream in streams:
+                with stream:
+                    if args.dsa:
+                        augmented.append(DiffAugment(img, args.dsa_strategy, param=args.dsa_param))
+                    else:
+                        augmented.append(augment(img.clone(), args.dc_aug_param, device=args.device)) # augment works in place
+            img = torch.stack(augmented)
+
+        if args.dataset == "ImageNet" and mode != "train":
+            lab = torch.tensor([class_map[x.item()] for x in lab]).to(args.device)
+
+        n_b = lab.shape[0]
+
+        with torch.set_grad_enabled(mode == 'train'):
+            output = forward(params, img)
+            losses = torch.stack([criterion(o, lab) for o in output])
+
+        loss_avg += losses.detach().cpu() * n_b
+        acc_avg += (output.argmax(-1) == lab).sum(1).cpu()
+        num_exp += n_b
+
+        if mode == 'train':
+            optimizer.zero_grad()
+            losses.sum().backward() # teachers do not share parameters, so each gets the gradient of its own loss
+            optimizer.step()
+
+    return (loss_avg / num_exp).tolist(), (acc_avg / num_exp).tolist()
+
+
+def train_ensemble(first, K, channel, num_classes, im_size, trainloader, testloader, criterion, args):
+    # Teachers first .. first + K - 1 trained together -> their trajectories, in the format of the sequential loop.
+    # Each teacher has its own RNG stream (initialization and augmentation), the batches are shared.
+    streams = [RNGStream(args.seed * 100003 + first + k) for k in range(K)]
+    nets = []
+    for stream in streams:
+        with stream:
+            nets.append(get_network(args.model, channel, num_classes, im_size).to(args.device))
+    net = nets[0]
+    assert len(list(net.buffers())) == 0, f"--ensemble needs a model without buffers (e.g. no batchnorm), {args.model} has {[n for n, _ in net.named_buffers()]}"
+    names = [n for n, _ in net.named_parameters()]
+    params = {n: torch.stack([dict(m.named_parameters())[n].detach() for m in nets]).requires_grad_(True) for n in names}
+    del nets
+
+    lr = args.lr_teacher
+    teacher_optim = torch.optim.SGD(params.values(), lr=lr, momentum=args.mom, weight_decay=args.l2)
+    teacher_optim.zero_grad()
+
+    # clone, so that each saved tensor holds only its own teacher and not the whole stack
+    snapshot = lambda: [[params[n][k].detach().cpu().clone() for n in names] for k in range(K)]
+    trajectories = [[timestamps] for timestamps in snapshot()]
+
+    lr_schedule = [args.train_epochs // 2 + 1]
+
+    for e in range(args.train_epochs):
+
+        train_loss, train_acc = ensemble_epoch("train", dataloader=trainloader, net=net, params=params, optimizer=teacher_optim, criterion=criterion, streams=streams, args=args, aug=True)
+
+        test_loss, test_acc = ensemble_epoch("test", dataloader=testloader, net=net, params=params, optimizer=None, criterion=criterion, streams=streams, args=args, aug=False)
+
+        for k in range(K):
+            save_and_print(args.log_path, "Itr: {}\tEpoch: {}\tTrain Acc: {}\tTest Acc: {}".format(first + k, e, train_acc[k], test_acc[k]))
+
+        for timestamps, params_k in zip(trajectories, snapshot()):
+            timestamps.append(params_k)
+
+        if e in lr_schedule and args.decay:
+            lr *= 0.1
+            teacher_optim = torch.optim.SGD(params.values(), lr=lr, momentum=args.mom, weight_decay=args.l2)
+            teacher_optim.zero_grad()
+
+    return trajectories
+
+
 def main(args):
     args.dsa = True if args.dsa == 'True' else False
     args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -67,45 +194,53 @@ def main(args):
     args.dc_aug_param['strategy'] = 'crop_scale_rotate'
     save_and_print(args.log_path, f'DC augmentation parameters: {args.dc_aug_param}')
 
-    for it in range(0, args.num_experts):
+    for it in range(0, args.num_experts, args.ensemble):
+
+        if args.ensemble > 1:
+            trajectories += train_ensemble(it, min(args.ensemble, args.num_experts - it), channel, num_classes, im_size, trainloader, testloader, criterion, args)
+        else:
 
-        ''' Train synthetic data '''
-        teacher_net = get_network(args.model, channel, num_classes, im_size).to(args.device)
-        teacher_net.train()
-        lr = args.lr_teacher
-        teacher_optim = torch.optim.SGD(teacher_net.parameters(), lr=lr, momentum=args.mom, weight_decay=args.l2)
-        teacher_optim.zero_grad()
+            ''' Train synthetic data '''
+            teacher_net = get_network(args.model, channel, num_classes, im_size).to(args.device)
+            teacher_net.train()
+            lr = args.lr_teacher
+            teacher_optim = torch.optim.SGD(teacher_net.parameters(), lr=lr, momentum=args.mom, weight_decay=args.l2)
+            teacher_optim.zero_grad()
 
-        timestamps = []
+            timestamps = []
 
-        timestamps.append([p.detach().cpu() for p in teacher_net.parameters()])
+            timestamps.append([p.detach().cpu() for p in teacher_net.parameters()])
 
-        lr_schedule = [args.train_epochs // 2 + 1]
+            lr_schedule = [args.train_epochs // 2 + 1]
 
-        for e in range(args.train_epochs):
+            for e in range(args.train_epochs):
 
-            train_loss, train_acc = epoch("train", dataloader=trainloader, net=teacher_net, optimizer=teacher_optim, criterion=criterion, args=args, aug=True)
+                train_loss, train_acc = epoch("train", dataloader=trainloader, net=teacher_net, optimizer=teacher_optim, criterion=criterion, args=args, aug=True)
 
-            test_loss, test_acc = epoch("test", dataloader=testloader, net=teacher_net, optimizer=None, criterion=criterion, args=args, aug=False)
+                test_loss, test_acc = epoch("test", dataloader=testloader, net=teacher_net, optimizer=None, criterion=criterion, args=args, aug=False)
 
-            save_and_print(args.log_path, "Itr: {}\tEpoch: {}\tTrain Acc: {}\tTest Acc: {}".format(it, e, train_acc, test_acc))
+                save_and_print(args.log_path, "Itr: {}\tEpoch: {}\tTrain Acc: {}\tTest Acc: {}".format(it, e, train_acc, test_acc))
 
-            timestamps.append([p.detach().cpu() for p in teacher_net.parameters()])
+                timestamps.append([p.detach().cpu() for p in teacher_net.parameters()])
 
-            if e in lr_schedule and args.decay:
-                lr *= 0.1
-                teacher_optim = torch.optim.SGD(teacher_net.parameters(), lr=lr, momentum=args.mom, weight_decay=args.l2)
-                teacher_optim.zero_grad()
+                if e in lr_schedule and args.decay:
+                    lr *= 0.1
+                    teacher_optim = torch.optim.SGD(teacher_net.parameters(), lr=lr, momentum=args.mom, weight_decay=args.l2)
+                    teacher_optim.zero_grad()
 
-        trajectories.append(timestamps)
+            trajectories.append(timestamps)
 
-        if len(trajectories) == args.save_interval:
+        while len(trajectories) >= args.save_interval:
+            saved, trajectories = trajectories[:args.save_interval], trajectories[args.save_interval:]
             n = 0
             while os.path.exists(os.path.join(save_dir, "replay_buffer_{}.pt".format(n))):
                 n += 1
-            save_and_print(args.log_path, "Saving {}".format(os.path.join(save_dir, "replay_buffer_{}.pt".format(n))))
-            torch.save(trajectories, os.path.join(save_dir, "replay_buffer_{}.pt".format(n)))
-            trajectories = []
+            if args.buffer_format == "store":
+                save_and_print(args.log_path, "Saving {} to the trajectory store of {}".format(len(saved), save_dir))
+                append_trajectories(save_dir, saved)
+            else:
+                save_and_print(args.log_path, "Saving {}".format(os.path.join(save_dir, "replay_buffer_{}.pt".format(n))))
+                torch.save(saved, os.path.join(save_dir, "replay_buffer_{}.pt".format(n)))
 
 
 if __name__ == '__main__':
@@ -129,6 +264,8 @@ if __name__ == '__main__':
     parser.add_argument('--mom', type=float, default=0, help='momentum')
     parser.add_argument('--l2', type=float, default=0, help='l2 regularization')
     parser.add_argument('--save_interval', type=int, default=10)
+    parser.add_argument('--ensemble', type=int, default=1, help='number of teachers trained together in one vmapped forward/backward pass (1: one after another)')
+    parser.add_argument('--buffer_format', type=str, default='pt', choices=['pt', 'store'], help='pt: replay_buffer_{n}.pt files, store: memory-mapped trajectory store (see trajectory_store.py)')
 
     parser.add_argument('--seed', type=int, default=0)
     args = parser.parse_args()
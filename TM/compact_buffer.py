@@ -0,0 +1,99 @@
+import os
+import hashlib
+import argparse
+import torch
+
+from trajectory_store import COMPACT, CompactTrajectory
+
+# Compaction of the expert buffers of buffer.py for TM.
+# TM only reads epochs 0 .. max_start_epoch + expert_epochs - 1 of each expert, so only that window is kept, optionally
+#   float16 / bfloat16  every epoch downcast
+#   delta16             epoch 0 in fp32, then fp16 differences to the previous reconstructed epoch (no drift over epochs)
+# and experts with identical initial parameters (e.g. buffers generated twice with the same seed) are dropped with --dedup.
+# The output directory gets replay_buffer_{n}.pt files that main_TM.py (and trajectory_store.py) read like the originals, e.g.
+#   python compact_buffer.py ../buffers/CIFAR10/ConvNet ../buffers_compact/CIFAR10/ConvNet --max_start_epoch 2 --expert_epochs 2 --dtype delta16
+#   python main_TM.py ... --buffer_path ../buffers_compact
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def compact(timestamps, epochs, dtype):
+    # [epoch][layer] of one expert -> per-layer tensors (epochs, *shape), or (fp32 epoch 0, fp16 deltas (epochs - 1, *shape)) for delta16
+    params = [torch.stack([timestamps[e][k].detach().to("cpu").float() for e in range(epochs)]) for k in range(len(timestamps[0]))]
+    if dtype != "delta16":
+        return [p.to(DTYPES[dtype]) for p in params]
+    compacted = []
+    for p in params:
+        deltas, previous = [], p[0].clone()
+        for e in range(1, epochs):
+            deltas.append((p[e] - previous).half())
+            previous += deltas[-1].float() # as CompactTrajectory reconstructs it
+        compacted.append((p[0].clone(), torch.stack(deltas) if len(deltas) > 0 else p[:0].half()))
+    return compacted
+
+
+def error(timestamps, trajectory):
+    # max abs and max relative (to the norm of the epoch) difference over all kept epochs
+    max_abs, max_rel = 0., 0.
+    for e in range(len(trajectory)):
+        original = torch.cat([p.detach().to("cpu").float().reshape(-1) for p in timestamps[e]])
+        diff = original - torch.cat([p.reshape(-1) for p in trajectory[e]])
+        max_abs = max(max_abs, diff.abs().max().item())
+        max_rel = max(max_rel, (diff.norm() / original.norm().clamp(min=1e-12)).item())
+    return max_abs, max_rel
+
+
+def digest(timestamps):
+    return hashlib.sha256(b"".join(p.detach().to("cpu").float().contiguous().numpy().tobytes() for p in timestamps[0])).hexdigest()
+
+
+def main(args):
+    epochs = args.max_start_epoch + args.expert_epochs
+    os.makedirs(args.out_dir, exist_ok=True)
+    seen = set()
+    n, m, size_in, size_out, num_experts, dropped, max_abs, max_rel = 0, 0, 0, 0, 0, 0, 0., 0.
+    while os.path.exists(os.path.join(args.expert_dir, "replay_buffer_{}.pt".format(n))):
+        path = os.path.join(args.expert_dir, "replay_buffer_{}.pt".format(n))
+        buffer = torch.load(path)
+        assert type(buffer) == list, f"{path} is already compacted"
+        experts = []
+        for timestamps in buffer:
+            assert len(timestamps) >= epochs, f"{path} has {len(timestamps)} epochs, max_start_epoch + expert_epochs = {epochs}"
+            if args.dedup:
+                key = digest(timestamps)
+                if key in seen:
+                    dropped += 1
+                    continue
+                seen.add(key)
+            experts.append(compact(timestamps, epochs, args.dtype))
+            abs_err, rel_err = error(timestamps, CompactTrajectory(experts[-1], args.dtype))
+            max_abs, max_rel = max(max_abs, abs_err), max(max_rel, rel_err)
+        del buffer
+
+        if len(experts) > 0:
+            out = os.path.join(args.out_dir, "replay_buffer_{}.pt".format(m))
+            torch.save({"format": COMPACT, "dtype": args.dtype, "epochs": epochs, "experts": experts}, out)
+            size_in += os.path.getsize(path)
+            size_out += os.path.getsize(out)
+            num_experts += len(experts)
+            print(f"{path} -> {out}: {os.path.getsize(path) / 2 ** 20:.1f} MB -> {os.path.getsize(out) / 2 ** 20:.1f} MB")
+            m += 1
+        n += 1
+
+    assert n > 0, f"No buffers detected at {args.expert_dir}"
+    print(f"{num_experts} experts ({dropped} duplicates dropped), epochs 0-{epochs - 1}, {args.dtype}")
+    print(f"size {size_in / 2 ** 20:.1f} MB -> {size_out / 2 ** 20:.1f} MB ({size_in / max(size_out, 1):.2f}x)")
+    print(f"reconstruction error: max abs {max_abs:.3e}, max relative {max_rel:.3e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Expert Buffer Compaction')
+    parser.add_argument('expert_dir', type=str, help='directory of the replay_buffer_{n}.pt files of buffer.py')
+    parser.add_argument('out_dir', type=str, help='directory of the compacted replay_buffer_{n}.pt files')
+    parser.add_argument('--max_start_epoch', type=int, required=True, help='as in the TM config')
+    parser.add_argument('--expert_epochs', type=int, required=True, help='as in the TM config')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float32', 'float16', 'bfloat16', 'delta16'])
+    parser.add_argument('--dedup', action='store_true', help='drop experts with the same initial parameters as an earlier one')
+    args = parser.parse_args()
+
+    main(args)
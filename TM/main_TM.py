@@ -12,6 +12,8 @@ import torchvision.utils
 from utils import get_dataset, get_network, get_eval_pool, evaluate_synset, get_time, DiffAugment, ParamDiffAug, set_seed, save_and_print, TensorDataset, get_images, epoch
 import random
 from reparam_module import ReparamModule
+from trajectory_store import TrajectoryStore, ExpertPrefetcher, load_buffer
+from unroll import unroll_graph, unroll_exact
 
 import shutil
 import matplotlib.pyplot as plt
@@ -91,6 +93,7 @@ def main(args):
     optimizer_lr = torch.optim.SGD([syn_lr], lr=args.lr_lr, momentum=0.5)
 
     criterion = nn.CrossEntropyLoss().to(args.device)
+    res_schedule = ResSchedule(args.res_schedule, im_size)
     save_and_print(args.log_path, '%s training begins'%get_time())
 
     expert_dir = os.path.join(args.buffer_path, args.dataset)
@@ -102,11 +105,19 @@ def main(args):
     expert_dir = os.path.join(expert_dir, args.model)
     save_and_print(args.log_path, "Expert Dir: {}".format(expert_dir))
 
-    if args.load_all:
+    if args.buffer_format == "store":
+        # memory-mapped trajectories, only the two epochs of an iteration are read (see trajectory_store.py)
+        store = TrajectoryStore(expert_dir)
+        expert_ids = store.experts(args.max_files, args.max_experts)
+        expert_idx = 0
+        random.shuffle(expert_ids)
+        save_and_print(args.log_path, "Trajectory store: {} experts of {} epochs".format(len(expert_ids), store.index["epochs"]))
+
+    elif args.load_all:
         buffer = []
         n = 0
         while os.path.exists(os.path.join(expert_dir, "replay_buffer_{}.pt".format(n))):
-            buffer = buffer + torch.load(os.path.join(expert_dir, "replay_buffer_{}.pt".format(n)))
+            buffer = buffer + load_buffer(os.path.join(expert_dir, "replay_buffer_{}.pt".format(n)))
             n += 1
         if n == 0:
             raise AssertionError("No buffers detected at {}".format(expert_dir))
@@ -119,16 +130,14 @@ def main(args):
             n += 1
         if n == 0:
             raise AssertionError("No buffers detected at {}".format(expert_dir))
-        file_idx = 0
         expert_idx = 0
         random.shuffle(expert_files)
         if args.max_files is not None:
             expert_files = expert_files[:args.max_files]
-        save_and_print(args.log_path, "loading file {}".format(expert_files[file_idx]))
-        buffer = torch.load(expert_files[file_idx])
-        if args.max_experts is not None:
-            buffer = buffer[:args.max_experts]
-        random.shuffle(buffer)
+        # the next files are loaded in the background while the current one is in use
+        prefetcher = ExpertPrefetcher(expert_files, args.max_experts, depth=args.prefetch_files, seed=args.seed)
+        buffer = prefetcher.next()
+        save_and_print(args.log_path, "loading file {} (waited {:.2f}s)".format(prefetcher.path, prefetcher.last_wait))
 
     best_acc = {m: 0 for m in model_eval_pool}
     best_std = {m: 0 for m in model_eval_pool}
@@ -246,6 +255,16 @@ def main(args):
 
                     del image_save, label_save, upsampled
 
+        # the full decode cached for the evaluation and the saved images would otherwise stay alive during the unroll
+        synset.release_decoded()
+
+        # The student network follows the expert trajectories at native resolution, so the synthetic images are decoded at the
+        # stage resolution and upsampled (this saves decoding, not the student network)
+        res = res_schedule.resolution(it)
+        if it > 0 and res_schedule.stage(it) != res_schedule.stage(it - 1):
+            save_and_print(args.log_path, f"Resolution {res} from iteration {it}\n{res_schedule.summary()}")
+        res_schedule.start()
+
         student_net = get_network(args.model, channel, num_classes, im_size, dist=False).to(args.device)
         student_net = ReparamModule(student_net)
         if args.distributed:
@@ -254,101 +273,70 @@ def main(args):
 
         num_params = sum([np.prod(p.size()) for p in (student_net.parameters())])
 
-        if args.load_all:
+        if args.buffer_format == "store":
+            if args.load_all:
+                expert_trajectory = store.expert(expert_ids[np.random.randint(0, len(expert_ids))])
+            else:
+                expert_trajectory = store.expert(expert_ids[expert_idx])
+                expert_idx += 1
+                if expert_idx == len(expert_ids):
+                    expert_idx = 0
+                    random.shuffle(expert_ids)
+                if args.prefetch_files > 0:
+                    store.prefetch(expert_ids[expert_idx])
+        elif args.load_all:
             expert_trajectory = buffer[np.random.randint(0, len(buffer))]
         else:
             expert_trajectory = buffer[expert_idx]
             expert_idx += 1
             if expert_idx == len(buffer):
                 expert_idx = 0
-                file_idx += 1
-                if file_idx == len(expert_files):
-                    file_idx = 0
-                    random.shuffle(expert_files)
-                if args.max_files != 1:
-                    del buffer
-                    buffer = torch.load(expert_files[file_idx])
-                if args.max_experts is not None:
-                    buffer = buffer[:args.max_experts]
-                random.shuffle(buffer)
+                del buffer
+                buffer = prefetcher.next()
+                save_and_print(args.log_path, "loading file {} (waited {:.2f}s, {:.2f}s in total)".format(prefetcher.path, prefetcher.last_wait, prefetcher.total_wait))
 
+        assert len(expert_trajectory) >= args.max_start_epoch + args.expert_epochs, "Expert trajectories have {} epochs, max_start_epoch + expert_epochs = {} are needed".format(len(expert_trajectory), args.max_start_epoch + args.expert_epochs)
         start_epoch = np.random.randint(0, args.max_start_epoch)
-        starting_params = expert_trajectory[start_epoch]
-
-        target_params = expert_trajectory[start_epoch+args.expert_epochs]
-        target_params = torch.cat([p.data.to(args.device).reshape(-1) for p in target_params], 0)
+        if args.buffer_format == "store":
+            starting_params = torch.tensor(expert_trajectory[start_epoch], device=args.device)
+            target_params = torch.tensor(expert_trajectory[start_epoch+args.expert_epochs], device=args.device)
+        else:
+            starting_params = expert_trajectory[start_epoch]
 
-        student_params = [torch.cat([p.data.to(args.device).reshape(-1) for p in starting_params], 0).requires_grad_(True)]
+            target_params = expert_trajectory[start_epoch+args.expert_epochs]
+            target_params = torch.cat([p.data.to(args.device).reshape(-1) for p in target_params], 0)
 
-        starting_params = torch.cat([p.data.to(args.device).reshape(-1) for p in starting_params], 0)
+            starting_params = torch.cat([p.data.to(args.device).reshape(-1) for p in starting_params], 0)
 
         indices_total = torch.randperm(synset.num_classes * synset.num_per_class)[:args.syn_steps * args.batch_syn]
-        image_syn, label_syn = synset.get(indices_total)
+        image_syn, label_syn = synset.get(indices_total, resolution=res)
+        image_syn = resize(image_syn, im_size)
         syn_images = image_syn
 
         y_hat = label_syn.to(args.device)
 
-        param_loss_list = []
-        param_dist_list = []
-        indices_chunks = []
-
-        for step in range(args.syn_steps):
-
-            if not indices_chunks:
-                indices = torch.randperm(len(syn_images))
-                indices_chunks = list(torch.split(indices, args.batch_syn))
-
-            these_indices = indices_chunks.pop()
-
-            x = syn_images[these_indices]
-            this_y = y_hat[these_indices]
-
-            if args.dsa and (not args.no_aug):
-                x = DiffAugment(x, args.dsa_strategy, param=args.dsa_param)
-
-            if args.distributed:
-                forward_params = student_params[-1].unsqueeze(0).expand(torch.cuda.device_count(), -1)
-            else:
-                forward_params = student_params[-1]
-            x = student_net(x, flat_param=forward_params)
-            ce_loss = criterion(x, this_y)
-
-            grad = torch.autograd.grad(ce_loss, student_params[-1], create_graph=True)[0]
-
-            student_params.append(student_params[-1] - syn_lr * grad)
-
-        param_loss = torch.tensor(0.0).to(args.device)
-        param_dist = torch.tensor(0.0).to(args.device)
-
-        param_loss += torch.nn.functional.mse_loss(student_params[-1], target_params, reduction="sum")
-        param_dist += torch.nn.functional.mse_loss(starting_params, target_params, reduction="sum")
-
-        param_loss_list.append(param_loss)
-        param_dist_list.append(param_dist)
-
-        param_loss /= num_params
-        param_dist /= num_params
-
-        param_loss /= param_dist
-
-        grand_loss = param_loss
-
         synset.optim_zero_grad()
         optimizer_lr.zero_grad()
 
-        grand_loss.backward()
+        if args.unroll == "exact":
+            # same gradient, recomputed step by step in reverse (see unroll.py)
+            grand_loss = unroll_exact(student_net, syn_images, y_hat, syn_lr, starting_params, target_params, num_params, criterion, args, segment=args.unroll_segment)
+        else:
+            grand_loss = unroll_graph(student_net, syn_images, y_hat, syn_lr, starting_params, target_params, num_params, criterion, args)
+            grand_loss.backward()
 
         synset.optim_step()
         optimizer_lr.step()
 
         syn_lr.data = syn_lr.data.clip(min=0.001)  # To avoid invalid syn_lr (refer to HaBa)
 
-        for _ in student_params:
-            del _
+        res_schedule.stop(it)
 
         if it % 10 == 0:
             save_and_print(args.log_path, '%s iter = %04d, loss = %.4f' % (get_time(), it, grand_loss.item()))
 
+    save_and_print(args.log_path, f"Time per resolution stage\n{res_schedule.summary()}")
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Parameter Processing')
 
@@ -373,6 +361,8 @@ if __name__ == '__main__':
     parser.add_argument('--no_aug', type=bool, default=False, help='this turns off diff aug during distillation')
     parser.add_argument('--max_files', type=int, default=None, help='number of expert files to read (leave as None unless doing ablations)')
     parser.add_argument('--max_experts', type=int, default=None, help='number of experts to read per file (leave as None unless doing ablations)')
+    parser.add_argument('--buffer_format', type=str, default='pt', choices=['pt', 'store'], help='pt: replay_buffer_{n}.pt files, store: memory-mapped trajectory store (see trajectory_store.py)')
+    parser.add_argument('--prefetch_files', type=int, default=1, help='expert files loaded ahead in the background (memory: prefetch_files + 1 files), 0 loads them when needed')
     parser.add_argument('--force_save', action='store_true', help='this will save images for 50ipc')
 
     ### Basic ###
@@ -382,6 +372,8 @@ if __name__ == '__main__':
     parser.add_argument('--save_path', type=str, default="./results")
 
     parser.add_argument('--syn_steps', type=int)
+    parser.add_argument('--unroll', type=str, default='graph', choices=['graph', 'exact'], help='graph: backward through the kept graph of all syn_steps, exact: same gradient with the graph of one step and O(sqrt(syn_steps)) parameter vectors alive (see unroll.py)')
+    parser.add_argument('--unroll_segment', type=int, default=0, help='exact: steps between parameter checkpoints (0: ceil(sqrt(syn_steps)))')
     parser.add_argument('--expert_epochs', type=int)
     parser.add_argument('--max_start_epoch', type=int)
     parser.add_argument('--lr_lr', type=float)
@@ -401,6 +393,7 @@ if __name__ == '__main__':
     parser.add_argument('--lr_nf', type=float)
     parser.add_argument('--epochs_init', type=int, default=5000)
     parser.add_argument('--lr_nf_init', type=float, default=5e-4)
+    add_synset_args(parser)
 
     args = parser.parse_args()
     set_seed(args.seed)
@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import queue
+import fcntl
+import random
+import argparse
+import threading
+import contextlib
+import numpy as np
+import torch
+
+# Memory-mapped store of expert trajectories, an alternative to the pickled replay_buffer_{n}.pt files of buffer.py.
+#   {expert_dir}/trajectories_{n}.npy  (num_experts, epochs + 1, num_params) float32, every epoch pre-flattened
+#                                      in the order of the network parameters (as torch.cat of main_TM.py)
+#   {expert_dir}/trajectories.json     index: parameter shapes, epochs and the files with their number of experts
+# The files are opened with np.load(mmap_mode="r"), so fetching the parameters of (expert, epoch) is a slice of the
+# mapping and only its pages are read. Read-only mappings of the same file share the OS page cache, so concurrent TM
+# jobs on a node read an expert from disk once. Files are written to a temporary name and moved in place, and the index
+# is updated under a lock, so converting or appending while other jobs read is safe.
+#   python trajectory_store.py ../buffers/CIFAR10/ConvNet      (convert the replay_buffer_{n}.pt files of a directory)
+
+INDEX = "trajectories.json"
+COMPACT = "compact"
+
+
+@contextlib.contextmanager
+def locked(expert_dir):
+    with open(os.path.join(expert_dir, "trajectories.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def flatten(timestamps):
+    # [epoch][layer] tensors of one expert -> (epochs + 1, num_params)
+    return np.stack([torch.cat([p.detach().to("cpu").reshape(-1) for p in params]).numpy() for params in timestamps]).astype(np.float32)
+
+
+class CompactTrajectory():
+    # One expert of a compacted buffer (see compact_buffer.py), expanded to fp32 one epoch at a time
+    # params: per-layer tensors (epochs, *shape) in float16/bfloat16/float32,
+    #         or for delta16 per-layer (fp32 epoch 0, fp16 differences to the previous epoch (epochs - 1, *shape))
+    def __init__(self, params, dtype):
+        self.params = params
+        self.dtype = dtype
+
+    def __len__(self):
+        if self.dtype == "delta16":
+            return 1 + len(self.params[0][1])
+        return len(self.params[0])
+
+    def __getitem__(self, epoch):
+        if epoch < 0:
+            epoch += len(self)
+        if not 0 <= epoch < len(self):
+            raise IndexError(f"epoch {epoch} of a trajectory of {len(self)} epochs")
+        if self.dtype != "delta16":
+            return [p[epoch].float() for p in self.params]
+        params = []
+        for base, deltas in self.params:
+            p = base.clone()
+            for delta in deltas[:epoch]: # accumulated in the order of compaction, so the error does not drift
+                p += delta.float()
+            params.append(p)
+        return params
+
+
+def load_buffer(path):
+    # replay_buffer_{n}.pt of buffer.py or of compact_buffer.py -> [expert][epoch][layer]
+    buffer = torch.load(path)
+    if type(buffer) == dict and buffer.get("format") == COMPACT:
+        buffer = [CompactTrajectory(params, buffer["dtype"]) for params in buffer["experts"]]
+    return buffer
+
+
+def read_index(expert_dir):
+    path = os.path.join(expert_dir, INDEX)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def append_trajectories(expert_dir, trajectories, source=None):
+    # trajectories: [expert][epoch][layer] tensors (the content of a replay_buffer_{n}.pt) -> name of the new file
+    experts = np.stack([flatten(timestamps) for timestamps in trajectories])
+    shapes = [list(p.shape) for p in trajectories[0][0]]
+    with locked(expert_dir):
+        index = read_index(expert_dir) or {"shapes": shapes, "num_params": int(experts.shape[2]), "epochs": int(experts.shape[1]), "dtype": "float32", "files": []}
+        assert index["shapes"] == shapes and index["epochs"] == experts.shape[1], f"Trajectories of {source or 'buffer'} do not match the store at {expert_dir}"
+        name = f"trajectories_{len(index['files'])}.npy"
+        tmp = os.path.join(expert_dir, f"{name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, experts)
+        os.replace(tmp, os.path.join(expert_dir, name))
+        index["files"].append({"file": name, "num_experts": int(experts.shape[0]), "source": source})
+        with open(os.path.join(expert_dir, f"{INDEX}.{os.getpid()}.tmp"), "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(os.path.join(expert_dir, f"{INDEX}.{os.getpid()}.tmp"), os.path.join(expert_dir, INDEX))
+    return name
+
+
+def convert_buffers(expert_dir):
+    # replay_buffer_{n}.pt files not in the store yet -> trajectories_{m}.npy
+    index = read_index(expert_dir) or {"files": []}
+    converted = {f["source"] for f in index["files"]}
+    n, names = 0, []
+    while os.path.exists(os.path.join(expert_dir, f"replay_buffer_{n}.pt")):
+        source = f"replay_buffer_{n}.pt"
+        if source not in converted:
+            names.append(append_trajectories(expert_dir, load_buffer(os.path.join(expert_dir, source)), source=source))
+            print(f"{source} -> {names[-1]}")
+        n += 1
+    return names
+
+
+class TrajectoryStore():
+    def __init__(self, expert_dir):
+        self.expert_dir = expert_dir
+        self.index = read_index(expert_dir)
+        assert self.index is not None, f"No trajectory store at {expert_dir} (convert the buffers with: python trajectory_store.py {expert_dir})"
+        self.files = [None] * len(self.index["files"])
+        self.offsets = np.cumsum([0] + [f["num_experts"] for f in self.index["files"]])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def experts(self, max_files=None, max_experts=None):
+        # expert ids of the first max_files files, at most max_experts per file (as the options of main_TM.py)
+        ids = []
+        for k in range(len(self.files))[:max_files]:
+            ids += list(range(self.offsets[k], self.offsets[k + 1]))[:max_experts]
+        return ids
+
+    def file(self, k):
+        if self.files[k] is None:
+            self.files[k] = np.load(os.path.join(self.expert_dir, self.index["files"][k]["file"]), mmap_mode="r")
+        return self.files[k]
+
+    def expert(self, idx):
+        # (epochs + 1, num_params) mapping of expert idx, no data is read until it is sliced
+        k = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return self.file(k)[idx - self.offsets[k]]
+
+    def params(self, idx, epoch, device):
+        # flat parameters of expert idx after epoch (the only copy is the one to device)
+        return torch.tensor(self.expert(idx)[epoch], device=device)
+
+    def prefetch(self, idx):
+        # Ask the kernel to read expert idx into the page cache in the background (e.g. the next expert of main_TM.py)
+        if not hasattr(os, "posix_fadvise"):
+            return
+        k = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        array = self.file(k)
+        size = array.shape[1] * array.shape[2] * array.itemsize
+        with open(os.path.join(self.expert_dir, self.index["files"][k]["file"]), "rb") as f:
+            os.posix_fadvise(f.fileno(), array.offset + int(idx - self.offsets[k]) * size, size, os.POSIX_FADV_WILLNEED)
+
+
+class ExpertPrefetcher():
+    # Loads the replay_buffer_{n}.pt files of expert_files on a background thread while the current one is in use.
+    # Files are loaded in the given order, which is reshuffled after every pass, and the experts of each file are cut to
+    # max_experts and shuffled. At most depth files are loaded ahead of the one in use (depth + 1 files in memory once the
+    # previous buffer is released); depth 0 loads every file only when it is asked for. A single file is loaded once.
+    def __init__(self, expert_files, max_experts=None, depth=1, seed=0):
+        self.expert_files = list(expert_files)
+        self.max_experts = max_experts
+        self.rng = random.Random(seed) # own generator, the main loop's random stays deterministic
+        self.slots = threading.Semaphore(depth + 1)
+        self.queue = queue.Queue()
+        self.in_use = False
+        self.buffer = None
+        self.path = None
+        self.last_wait = 0.
+        self.total_wait = 0.
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def load(self, path):
+        buffer = load_buffer(path)
+        if self.max_experts is not None:
+            buffer = buffer[:self.max_experts]
+        self.rng.shuffle(buffer)
+        return buffer
+
+    def worker(self):
+        files = self.expert_files
+        while True:
+            for path in files:
+                self.slots.acquire()
+                try:
+                    self.queue.put((path, self.load(path)))
+                except Exception as e:
+                    self.queue.put((path, e))
+                    return
+                if len(self.expert_files) == 1:
+                    return
+            files = list(self.expert_files)
+            self.rng.shuffle(files)
+
+    def next(self):
+        # Next shuffled buffer; the caller drops its reference to the previous one first (del buffer)
+        if len(self.expert_files) == 1 and self.buffer is not None:
+            self.rng.shuffle(self.buffer)
+            self.last_wait = 0.
+            return self.buffer
+        if self.in_use:
+            self.slots.release()
+        start = time.time()
+        self.path, buffer = self.queue.get()
+        self.last_wait = time.time() - start
+        self.total_wait += self.last_wait
+        if isinstance(buffer, Exception):
+            raise buffer
+        self.in_use = True
+        if len(self.expert_files) == 1:
+            self.buffer = buffer
+        return buffer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trajectory Store Conversion')
+    parser.add_argument('expert_dir', type=str, help='directory of the replay_buffer_{n}.pt files')
+    args = parser.parse_args()
+
+    names = convert_buffers(args.expert_dir)
+    store = TrajectoryStore(args.expert_dir)
+    print(f"Converted {len(names)} files, {len(store)} experts of {store.index['epochs']} epochs x {store.index['num_params']} parameters in {args.expert_dir}")
@@ -0,0 +1,126 @@
+import math
+import torch
+from utils import DiffAugment
+
+# Unrolled student training of trajectory matching and the gradient of the matching loss.
+#   graph   every step keeps its student parameters and the create_graph=True graph, backward goes through all of them
+#           (memory grows with syn_steps x (batch_syn activations + |params|))
+#   exact   the steps run without a graph, keeping the batch indices and RNG state of each step and the detached parameters
+#           only every `segment` steps (checkpoints). The backward pass walks the segments in reverse: it recomputes the
+#           parameters of a segment from its checkpoint (same batches, same RNG, so bit for bit the same), then walks its
+#           steps in reverse, recomputes each step's gradient and propagates the adjoint with one Hessian-vector product.
+#           The meta-gradient is the same as the graph mode's; at most one step's graph is alive and
+#           syn_steps / segment + segment parameter vectors are kept (2 sqrt(syn_steps) with the default segment), at the
+#           cost of one more gradient evaluation per step.
+# The gradient parity of both modes is checked by tests/test_unroll.py.
+
+
+def student_forward(student_net, params, x, args):
+    if args.distributed:
+        params = params.unsqueeze(0).expand(torch.cuda.device_count(), -1)
+    return student_net(x, flat_param=params)
+
+
+def rng_state():
+    return (torch.get_rng_state(), torch.cuda.get_rng_state() if torch.cuda.is_available() else None)
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state[0])
+    if torch.cuda.is_available():
+        torch.cuda.set_rng_state(state[1])
+
+
+def batches(num_images, args):
+    # indices of the syn_steps batches, as drawn by the original loop
+    indices_chunks = []
+    for step in range(args.syn_steps):
+        if not indices_chunks:
+            indices = torch.randperm(num_images)
+            indices_chunks = list(torch.split(indices, args.batch_syn))
+        yield indices_chunks.pop()
+
+
+def augment(x, args):
+    if args.dsa and (not args.no_aug):
+        x = DiffAugment(x, args.dsa_strategy, param=args.dsa_param)
+    return x
+
+
+def matching_loss(student_params, starting_params, target_params, num_params):
+    param_loss = torch.nn.functional.mse_loss(student_params, target_params, reduction="sum") / num_params
+    param_dist = torch.nn.functional.mse_loss(starting_params, target_params, reduction="sum") / num_params
+    return param_loss / param_dist
+
+
+def unroll_graph(student_net, syn_images, y_hat, syn_lr, starting_params, target_params, num_params, criterion, args):
+    # -> loss with the graph through all steps (to be backwarded by the caller)
+    student_params = [starting_params.clone().requires_grad_(True)]
+    for these_indices in batches(len(syn_images), args):
+        x = augment(syn_images[these_indices], args)
+        ce_loss = criterion(student_forward(student_net, student_params[-1], x, args), y_hat[these_indices])
+        grad = torch.autograd.grad(ce_loss, student_params[-1], create_graph=True)[0]
+        student_params.append(student_params[-1] - syn_lr * grad)
+    return matching_loss(student_params[-1], starting_params, target_params, num_params)
+
+
+def sgd_step(student_net, params, images, y_hat, these_indices, state, lr, criterion, args):
+    # one step of the student from params, replaying the RNG state of the step (no graph) -> next params
+    set_rng_state(state)
+    x = augment(images[these_indices].detach(), args)
+    with torch.enable_grad():
+        p = params.clone().requires_grad_(True)
+        grad = torch.autograd.grad(criterion(student_forward(student_net, p, x, args), y_hat[these_indices]), p)[0]
+    return params - lr * grad
+
+
+def unroll_exact(student_net, syn_images, y_hat, syn_lr, starting_params, target_params, num_params, criterion, args, segment=0):
+    # -> detached loss; its gradient is accumulated into syn_images (backwarded to what it was computed from) and syn_lr.grad
+    # segment: steps between parameter checkpoints (0: ceil(sqrt(syn_steps)))
+    images = syn_images.detach().requires_grad_(True)
+    lr = syn_lr.detach()
+    segment = segment if segment > 0 else max(1, math.ceil(math.sqrt(args.syn_steps)))
+
+    # forward: batch and RNG state of each step and the parameters every segment steps, no graph
+    steps, checkpoints = [], []
+    params = starting_params.detach()
+    for step, these_indices in enumerate(batches(len(images), args)):
+        if step % segment == 0:
+            checkpoints.append(params)
+        steps.append((these_indices, rng_state()))
+        params = sgd_step(student_net, params, images, y_hat, *steps[-1], lr, criterion, args)
+    end_state = rng_state()
+
+    final = params.requires_grad_(True)
+    loss = matching_loss(final, starting_params, target_params, num_params)
+    adjoint = torch.autograd.grad(loss, final)[0]
+    del params, final
+
+    # backward: adjoint of the parameters after each step, segment by segment in reverse order
+    images_grad = torch.zeros_like(images)
+    lr_grad = torch.zeros_like(lr)
+    for k in reversed(range(len(checkpoints))):
+        segment_steps = steps[k * segment:(k + 1) * segment]
+        segment_params = [checkpoints.pop()]
+        for these_indices, state in segment_steps[:-1]:
+            segment_params.append(sgd_step(student_net, segment_params[-1], images, y_hat, these_indices, state, lr, criterion, args))
+        for params, (these_indices, state) in zip(reversed(segment_params), reversed(segment_steps)):
+            set_rng_state(state)
+            p = params.clone().requires_grad_(True)
+            x = augment(images[these_indices], args)
+            grad = torch.autograd.grad(criterion(student_forward(student_net, p, x, args), y_hat[these_indices]), p, create_graph=True)[0]
+            # params_next = p - lr * grad: d/dp = adjoint - lr * H adjoint, d/dx = -lr * d(adjoint . grad)/dx, d/dlr = -adjoint . grad
+            vjp = (adjoint * grad).sum()
+            p_grad, x_grad = torch.autograd.grad(vjp, [p, images])
+            lr_grad -= vjp.detach()
+            images_grad -= lr * x_grad
+            adjoint = adjoint - lr * p_grad
+        del segment_params
+    set_rng_state(end_state)
+
+    syn_images.backward(images_grad)
+    if syn_lr.grad is None:
+        syn_lr.grad = lr_grad
+    else:
+        syn_lr.grad += lr_grad
+    return loss.detach()
@@ -11,6 +11,8 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 import shutil
 from hyper_params import load_default
 from DDiF import DDiF
+from SynSet.res_schedule import ResSchedule, resize
+from SynSet.arguments import add_synset_args
 from utils import set_seed, save_and_print, get_videos, evaluate_synset_nf
 
 def main(args):
@@ -53,6 +55,7 @@ def main(args):
     best_acc = {m: 0 for m in model_eval_pool}
     best_std = {m: 0 for m in model_eval_pool}
 
+    res_schedule = ResSchedule(args.res_schedule, (args.frames, *im_size))
     save_and_print(args.log_path, '%s training begins' % get_time())
 
     for it in range(0, args.Iteration + 1):
@@ -101,7 +104,12 @@ def main(args):
                 synset.save(name=f"DDiF_DM_{args.ipc}ipc#synset_best.pt")
 
         ''' Train synthetic data '''
-        net = get_network(args.model, channel, num_classes, im_size).to(args.device)  # get a random model
+        res = res_schedule.resolution(it)
+        if it > 0 and res_schedule.stage(it) != res_schedule.stage(it - 1):
+            save_and_print(args.log_path, f"Resolution {res} from iteration {it}\n{res_schedule.summary()}")
+        res_schedule.start()
+
+        net = get_network(args.model, channel, num_classes, res[1:], frames=res[0]).to(args.device)  # get a random model
         net.train()
         for param in list(net.parameters()):
             param.requires_grad = False
@@ -114,14 +122,14 @@ def main(args):
             loss_c = torch.tensor(0.0).to(args.device)
 
             vid_real = get_videos(video_all, indices_class, c, args.batch_real)
-            vid_real = vid_real.to(args.device)
+            vid_real = resize(vid_real.to(args.device), res, channel_dim=2)
 
             if args.batch_syn > 0:
                 indices = np.random.permutation(range(c * synset.num_per_class, (c + 1) * synset.num_per_class))[:args.batch_syn]
             else:
                 indices = range(c * synset.num_per_class, (c + 1) * synset.num_per_class)
 
-            vid_syn, lab_syn = synset.get(indices=indices)
+            vid_syn, lab_syn = synset.get(indices=indices, resolution=res)
 
             output_real = embed(vid_real).detach()
             output_syn = embed(vid_syn)
@@ -136,10 +144,13 @@ def main(args):
         loss_avg = loss.item()
 
         loss_avg /= (num_classes)
+        res_schedule.stop(it)
 
         if it % 10 == 0:
             save_and_print(args.log_path, '%s iter = %04d, loss = %.4f' % (get_time(), it, loss_avg))
 
+    save_and_print(args.log_path, f"Time per resolution stage\n{res_schedule.summary()}")
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Parameter Processing')
     parser.add_argument('--method', type=str, default='DM')
@@ -182,6 +193,7 @@ if __name__ == '__main__':
     parser.add_argument('--lr_nf', type=float)
     parser.add_argument('--epochs_init', type=int, default=5000)
     parser.add_argument('--lr_nf_init', type=float, default=5e-4)
+    add_synset_args(parser)
 
     args = parser.parse_args()
     set_seed(args.seed)
@@ -0,0 +1,78 @@
+import os
+import sys
+import socket
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.distributed as dist
+import torch.multiprocessing as mp
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "SynSet"))
+from field_bank import SirenBank, coordinate_grid
+from distributed import shard_bounds, build_shard, sync_rng, GatherDecoded
+
+CFG = dict(dim_in=2, dim_hidden=8, dim_out=3, num_layers=2, w0_initial=30., w0=10.)
+NUM_INSTANCES, WORLD_SIZE = 5, 2
+
+
+def matching_step(bank, decode, consumed):
+    # shard-dependent consumption of random numbers (as the initialization of a shard), then the replicated matching loss
+    torch.randn(consumed)
+    sync_rng(1)
+    decoded = decode(coordinate_grid((4, 4), (4, 4), (3, 3), "cpu"))
+    weight = torch.randn_like(decoded)
+    loss = (decoded * weight).sum() + (decoded ** 2).mean()
+    loss.backward()
+    return loss.detach(), [p.grad for p in bank.stacked_params()]
+
+
+def full_bank():
+    torch.manual_seed(0)
+    return SirenBank(num_instances=NUM_INSTANCES, **CFG)
+
+
+def run(rank, port, path):
+    os.environ["MASTER_ADDR"], os.environ["MASTER_PORT"] = "127.0.0.1", str(port)
+    dist.init_process_group(backend="gloo", rank=rank, world_size=WORLD_SIZE)
+    start, stop = shard_bounds(NUM_INSTANCES, rank, WORLD_SIZE)
+    counts = [b - a for a, b in (shard_bounds(NUM_INSTANCES, r, WORLD_SIZE) for r in range(WORLD_SIZE))]
+    bank = SirenBank(num_instances=stop - start, **CFG)
+    bank.load_stacked_params([p[start:stop] for p in full_bank().stacked_params()])
+    loss, grads = matching_step(bank, lambda coord: GatherDecoded.apply(bank(coord), counts, rank), consumed=17 * (rank + 1))
+    torch.save({"loss": loss, "grads": grads}, os.path.join(path, f"{rank}.pt"))
+    dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_sharded_decode_matches_single_process(tmp_path):
+    mp.spawn(run, args=(free_port(), str(tmp_path)), nprocs=WORLD_SIZE)
+
+    bank = full_bank()
+    loss, grads = matching_step(bank, bank, consumed=3)
+    for rank in range(WORLD_SIZE):
+        start, stop = shard_bounds(NUM_INSTANCES, rank, WORLD_SIZE)
+        result = torch.load(os.path.join(tmp_path, f"{rank}.pt"))
+        assert torch.allclose(result["loss"], loss, rtol=1e-6)
+        for g, h in zip(result["grads"], grads):
+            assert torch.allclose(g, h[start:stop], rtol=1e-5, atol=1e-7)
+
+
+def test_init_does_not_depend_on_the_number_of_processes():
+    build = lambda num_instances: SirenBank(num_instances=num_instances, **CFG)
+    torch.manual_seed(0)
+    single = build_shard(build, NUM_INSTANCES, (0, NUM_INSTANCES))
+    after_single = torch.rand(1)
+    for rank in range(WORLD_SIZE):
+        start, stop = shard_bounds(NUM_INSTANCES, rank, WORLD_SIZE)
+        torch.manual_seed(0)
+        shard = build_shard(build, NUM_INSTANCES, (start, stop))
+        assert shard.num_instances == stop - start
+        for p, q in zip(shard.stacked_params(), single.stacked_params()):
+            assert torch.equal(p, q[start:stop])
+        # the random numbers left for what follows are the same as well
+        assert torch.equal(torch.rand(1), after_single)
@@ -0,0 +1,76 @@
+import os
+import sys
+import pytest
+
+torch = pytest.importorskip("torch")
+from torch import nn
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "SynSet"))
+from field_bank import SirenBank, SparseFieldAdam, coordinate_grid
+
+CFG = dict(dim_in=2, dim_hidden=8, dim_out=3, num_layers=2, w0_initial=30., w0=10.)
+
+
+class SirenLayer(nn.Module):
+    # a layer of the per-instance Siren the bank replaced
+    def __init__(self, dim_in, dim_out, w0=None):
+        super().__init__()
+        self.linear = nn.Linear(dim_in, dim_out)
+        self.w0 = w0
+
+    def forward(self, x):
+        x = self.linear(x)
+        return x if self.w0 is None else torch.sin(self.w0 * x)
+
+
+class Siren(nn.Module):
+    def __init__(self, dim_in, dim_hidden, dim_out, num_layers, w0_initial, w0):
+        super().__init__()
+        self.net = nn.Sequential(*[SirenLayer(dim_in if i == 0 else dim_hidden, dim_hidden, w0_initial if i == 0 else w0) for i in range(num_layers)])
+        self.last_layer = SirenLayer(dim_hidden, dim_out)
+
+    def forward(self, x):
+        return self.last_layer(self.net(x))
+
+
+def test_bank_with_sparse_adam_matches_separate_sirens_with_adam():
+    torch.manual_seed(0)
+    num_instances, lr = 6, 1e-3
+    bank = SirenBank(num_instances=num_instances, **CFG).double()
+    sirens = [Siren(**CFG).double() for _ in range(num_instances)]
+    for idx, siren in enumerate(sirens):
+        siren.load_state_dict(bank.instance_state_dict(idx))
+    optimizer = SparseFieldAdam(bank, lr=lr)
+    optimizer_ref = torch.optim.Adam([p for siren in sirens for p in siren.parameters()], lr=lr)
+
+    coord = coordinate_grid((5, 5), (5, 5), (4, 4), "cpu").double()
+    target = torch.randn(num_instances, len(coord), CFG["dim_out"], dtype=torch.double)
+    # partial batches: some fields skip steps, field 5 is decoded only late
+    batches = [[0, 1, 2], [0, 3], [1, 2, 3, 4], [0], [2, 5], [0, 1, 2, 3, 4, 5]]
+
+    for batch in batches:
+        indices = torch.tensor(batch)
+        optimizer.touch(indices)
+        loss = ((bank(coord, indices) - target[indices]) ** 2).mean(dim=(1, 2)).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        loss_ref = sum(((sirens[idx](coord) - target[idx]) ** 2).mean() for idx in batch)
+        optimizer_ref.zero_grad()
+        loss_ref.backward()
+        optimizer_ref.step()
+
+        for idx, siren in enumerate(sirens):
+            for key, value in siren.state_dict().items():
+                assert torch.allclose(bank.instance_state_dict(idx)[key], value, rtol=1e-7, atol=1e-10), (batch, idx, key)
+
+
+@pytest.mark.parametrize("max_bytes", [0, 1])
+def test_fit_in_float64(max_bytes):
+    # max_bytes=1 takes the coordinate-chunked path
+    torch.manual_seed(0)
+    bank = SirenBank(num_instances=3, **CFG).double()
+    coord = coordinate_grid((4, 4), (4, 4), (3, 3), "cpu").double()
+    values = torch.rand(3, len(coord), 3, dtype=torch.double)
+    recon_loss = bank.fit(torch.arange(3), coord, values, epochs=3, lr=1e-3, max_bytes=max_bytes)
+    assert recon_loss.dtype == torch.double and recon_loss.shape == (3,)
@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+torch = pytest.importorskip("torch")
+for module in ["kornia", "torchvision", "scipy", "tqdm"]:
+    pytest.importorskip(module)
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "TM"))
+from buffer import RNGStream
+from utils import augment
+
+DC_AUG_PARAM = {'crop': 4, 'scale': 0.2, 'rotate': 45, 'noise': 0.001, 'strategy': 'crop_scale_rotate'}
+
+
+def draw(stream, images):
+    with stream:
+        return augment(images.clone(), DC_AUG_PARAM, device="cpu")
+
+
+def test_non_dsa_augment_is_reproducible_per_stream():
+    images = torch.rand(8, 3, 16, 16)
+    np.random.seed(0)
+    first = draw(RNGStream(1), images)
+    # the global numpy stream is neither used nor moved by a stream
+    state = np.random.get_state()[1].copy()
+    np.random.rand(5)
+    assert torch.equal(draw(RNGStream(1), images), first)
+    assert not torch.equal(draw(RNGStream(2), images), first)
+    np.random.seed(0)
+    draw(RNGStream(1), images)
+    assert np.array_equal(np.random.get_state()[1], state)
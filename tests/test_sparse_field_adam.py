@@ -0,0 +1,37 @@
+import os
+import sys
+import pytest
+
+torch = pytest.importorskip("torch")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "SynSet"))
+from field_bank import SirenBank, SparseFieldAdam, coordinate_grid
+
+CFG = dict(dim_in=2, dim_hidden=8, dim_out=3, num_layers=2, w0_initial=30., w0=10.)
+
+
+def decode_step(bank, optimizer, coord, indices):
+    optimizer.touch(indices)
+    loss = (bank(coord, indices) ** 2).mean()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def test_untouched_rows_keep_parameters_moments_and_steps():
+    torch.manual_seed(0)
+    bank = SirenBank(num_instances=6, **CFG)
+    optimizer = SparseFieldAdam(bank, lr=1e-3)
+    coord = coordinate_grid((4, 4), (4, 4), (3, 3), "cpu")
+
+    decode_step(bank, optimizer, coord, torch.tensor([0, 1, 2]))
+    params = [p.detach().clone() for p in bank.stacked_params()]
+    moments = [m.clone() for m in optimizer.exp_avgs]
+    decode_step(bank, optimizer, coord, torch.tensor([0, 3]))
+
+    assert optimizer.steps.tolist() == [2, 1, 1, 1, 0, 0]
+    for p, q, m, n in zip(bank.stacked_params(), params, optimizer.exp_avgs, moments):
+        # rows 1 and 2 were not decoded in the second step: no drift on momentum, no decay of the moments
+        assert torch.equal(p[1:3], q[1:3]) and torch.equal(m[1:3], n[1:3])
+        assert not torch.equal(p[3], q[3])
+        # rows never decoded are untouched
+        assert torch.equal(p[4:], q[4:]) and not m[4:].any()
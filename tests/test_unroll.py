@@ -0,0 +1,50 @@
+import os
+import sys
+from argparse import Namespace
+import pytest
+
+torch = pytest.importorskip("torch")
+for module in ["kornia", "torchvision", "scipy"]:
+    pytest.importorskip(module)
+import torch.nn as nn
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "TM"))
+from utils import ParamDiffAug
+from reparam_module import ReparamModule
+from unroll import unroll_graph, unroll_exact
+
+SYN_STEPS, NUM_IMAGES, RES = 8, 20, 8
+
+
+def meta_gradient(mode, segment=0):
+    # scale and rotate build float32 grids, the check runs in float64
+    args = Namespace(syn_steps=SYN_STEPS, batch_syn=6, dsa=True, no_aug=False, distributed=False,
+                     dsa_strategy='color_crop_cutout_flip', dsa_param=ParamDiffAug())
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Conv2d(3, 8, 3, padding=1), nn.GroupNorm(8, 8), nn.Tanh(), nn.AvgPool2d(2), nn.Flatten(), nn.Linear(8 * (RES // 2) ** 2, 10))
+    student_net = ReparamModule(net.double())
+    num_params = student_net.flat_param.numel()
+    starting_params = student_net.flat_param.detach().clone()
+    target_params = starting_params + 0.01 * torch.randn_like(starting_params)
+    source = torch.randn(NUM_IMAGES, 3, RES, RES, dtype=torch.double, requires_grad=True)
+    y_hat = torch.randint(0, 10, (NUM_IMAGES,))
+    syn_lr = torch.tensor(0.01, dtype=torch.double).requires_grad_(True)
+    syn_images = source * 1. # non-leaf, as the decoded synset
+
+    torch.manual_seed(1) # same batches and augmentations in both modes
+    if mode == "graph":
+        loss = unroll_graph(student_net, syn_images, y_hat, syn_lr, starting_params, target_params, num_params, nn.CrossEntropyLoss(), args)
+        loss.backward()
+    else:
+        loss = unroll_exact(student_net, syn_images, y_hat, syn_lr, starting_params, target_params, num_params, nn.CrossEntropyLoss(), args, segment=segment)
+    return loss.item(), source.grad, syn_lr.grad, torch.rand(1)
+
+
+@pytest.mark.parametrize("segment", [0, 1, 3, SYN_STEPS])
+def test_exact_matches_graph(segment):
+    loss_g, images_g, lr_g, after_g = meta_gradient("graph")
+    loss_e, images_e, lr_e, after_e = meta_gradient("exact", segment)
+    assert abs(loss_g - loss_e) <= 1e-10 * abs(loss_g)
+    assert ((images_g - images_e).norm() / images_g.norm()).item() < 1e-8
+    assert (abs(lr_g - lr_e) / abs(lr_g)).item() < 1e-8
+    # the RNG is left where the graph unroll leaves it
+    assert torch.equal(after_g, after_e)